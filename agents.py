@@ -1,17 +1,28 @@
 from gym_cribbage.envs.cribbage_env import (
     CribbageEnv,
+    best_discard,
     evaluate_cards,
+    pegging_values,
     Deck,
     Card,
     Stack,
-    State
+    State,
+    MAX_TABLE_VALUE
 )
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, repeat
+from math import ceil, log, log2, sqrt
+from statistics import NormalDist
 import numpy as np
 import random as rand
 import pandas as pd
 import logging
 import copy
 import datetime
+import time
+
+# typical points of a hand, to scale the ISMCTS exploration
+REWARD_SCALE = 10
 
 
 class Player(object):
@@ -97,18 +108,19 @@ class Greedy(HighCard):
         # track cards to discard
         top_score = -1
 
-        # if haven't found best set of cards
+        # if haven't found best set of cards. keeps 4 cards: 2 are thrown
+        # from a 6 card hand, 1 from a 5 card hand (3 or 4 players)
         if self.next_discard is None:
-            for i in range(5):
-                for j in range(i+1, 6):
-                    _hand = hand
-                    _hand = _hand.remove(hand[i])
-                    _hand = _hand.remove(hand[j])
-                    score = evaluate_cards(_hand)
-                    if score > top_score:
-                        to_discard = [hand[i], hand[j]]
-                        top_score = score
-            self.next_discard = to_discard[1]
+            for to_throw in combinations(hand, len(hand) - 4):
+                _hand = hand
+                for c in to_throw:
+                    _hand = _hand.remove(c)
+                score = evaluate_cards(_hand)
+                if score > top_score:
+                    to_discard = list(to_throw)
+                    top_score = score
+            if len(to_discard) > 1:
+                self.next_discard = to_discard[1]
             return to_discard[0]
         else:
             next_discard = self.next_discard
@@ -119,10 +131,11 @@ class Greedy(HighCard):
         hand = self.get_hand(env)
         # track points
         points = []
+        _env = env.clone()
+        _env.verbose = False
+        snapshot = _env.snapshot()
         for c in hand:
-            _env = copy.deepcopy(env)
-            _env.verbose = False
-            _env.debug = False
+            _env.restore(snapshot)
             _, reward, _, _ = _env.step(c)
             points.append(reward)
         # if no points to be had, discard highest card
@@ -132,111 +145,230 @@ class Greedy(HighCard):
             return hand[points.index(max(points))]
 
 
+class ExpectedValue(Greedy):
+    # throw the 2 cards with the best exact expected hand and crib points,
+    # peg like Greedy
+    def __init__(self):
+        self.name = 'Expected Value'
+        self.next_discard = None
+
+    def discard(self, env):
+        if self.next_discard is None:
+            hand = self.get_hand(env)
+            if len(hand) != 6:
+                # the expected values are only known for 2 players
+                return super().discard(env)
+            dealer = env.dealer == env.player
+            to_discard = best_discard(list(hand), dealer)
+            self.next_discard = to_discard[1]
+            return to_discard[0]
+        else:
+            next_discard = self.next_discard
+            self.next_discard = None
+            return next_discard
+
+
+class Minimax(ExpectedValue):
+    # throw like ExpectedValue, peg the card with the best exact value for
+    # the rest of the play. it looks at the other players' hands, so it is
+    # meant for rollouts, where all the hands are simulated anyway
+    def __init__(self):
+        self.name = 'Minimax'
+        self.next_discard = None
+
+    def peg(self, env):
+        values = pegging_values(
+            env.hands, env.table, env.table_value, env.player)
+        return max(values, key=values.get)
+
+
+def _rollout(player_num, hand, dealer, n_players, policy, to_throw, seed):
+    # one simulated hand, in a worker process
+    agent = MonteCarlo(player_num=player_num)
+    new_env = agent.simulate_hand(Stack(list(hand)), dealer, n_players, seed)
+    return agent.score_hand(new_env, to_throw, policy(), policy())
+
+
+def _upper_bound(points, z):
+    # upper confidence bound of the mean of points
+    if len(points) < 2:
+        return np.inf
+    return points.mean() + z * points.std(ddof=1) / np.sqrt(len(points))
+
+
+def _rollout_splits(player_num, hand, dealer, n_players, policy, splits,
+                    seed):
+    # one simulated deal, played out once for each discard
+    agent = MonteCarlo(player_num=player_num)
+    new_env = agent.simulate_hand(Stack(list(hand)), dealer, n_players, seed)
+    snapshot = new_env.snapshot()
+    points = []
+    for to_throw in splits:
+        new_env.restore(snapshot)
+        points.append(agent.score_hand(new_env, to_throw, policy(), policy()))
+    return points
+
+
+# fewest rollouts per discard in a round of successive halving, below which
+# the halving mostly drops discards on noise
+MIN_ROUND_TRIALS = 5
+
+
 class MonteCarlo(Greedy):
-    # simulate remaining hand and play card with the highest expected value
-    def __init__(self, player_num=0, trials=10, verbose=False):
+    # simulate remaining hand and play card with the highest expected value.
+    # each rollout gets its own seed, so results for a given seed do not
+    # depend on the number of workers. with adaptive=True, the same budget
+    # of 15 * trials rollouts is spent by successive halving, stopping once
+    # the best discard is ahead of all others with the given confidence.
+    # with common_random_numbers=True, trial t deals the same opponent hand
+    # and starter for every discard, which makes the comparison between
+    # discards much less noisy. rollout_policy is the agent class playing
+    # the simulated hands, e.g. Minimax for stronger pegging.
+    def __init__(self, player_num=0, trials=10, verbose=False, n_workers=1,
+                 seed=None, adaptive=False, confidence=0.95,
+                 common_random_numbers=False, rollout_policy=Greedy):
         self.name = 'Monte Carlo- {}'.format(trials)
         self.trials = trials
         self.next_discard = None
-        if player_num == 0:
-            self.p2 = Greedy()
-        else:
-            self.p1 = Greedy()
         self.player_num = player_num
         self.verbose = verbose
-
-    def score_hand(self, env, card1, card2, my_strategy, opp_strategy):
-        # simulates the score of a hand given the dealt hand, the cards to discard,
-        # the pegging strategy, and the opponent's strategy
+        self.n_workers = n_workers
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.pool = None
+        self.adaptive = adaptive
+        self.confidence = confidence
+        self.common_random_numbers = common_random_numbers
+        self.rollout_policy = rollout_policy
+        # rollouts skipped by the last adaptive discard, once the best
+        # discard was separated from the others
+        self.rollouts_saved = 0
+
+    def close(self):
+        # shut down the worker processes
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def rollouts(self, hand, dealer, n_players, splits, trials):
+        # reward differences of `trials` simulated hands for each tuple of
+        # cards to throw in splits, as an array [len(splits), trials]
+        common = (repeat(self.player_num), repeat(tuple(hand)),
+                  repeat(dealer), repeat(n_players),
+                  repeat(self.rollout_policy))
+        if self.common_random_numbers:
+            # one deal per trial, shared by all the discards
+            seeds = self.seed_seq.spawn(1)[0].spawn(trials)
+            func, args = _rollout_splits, common + (repeat(splits), seeds)
+        else:
+            seeds = self.seed_seq.spawn(1)[0].spawn(len(splits) * trials)
+            to_throw = [split for split in splits for _ in range(trials)]
+            func, args = _rollout, common + (to_throw, seeds)
+
+        if self.n_workers > 1:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+            chunksize = max(1, len(seeds) // (4 * self.n_workers))
+            points = list(self.pool.map(func, *args, chunksize=chunksize))
+        else:
+            points = list(map(func, *args))
+
+        if self.common_random_numbers:
+            return np.array(points).T
+        return np.array(points).reshape(len(splits), trials)
+
+    def adaptive_rollouts(self, hand, dealer, n_players, splits):
+        # successive halving over the discards. returns the reward
+        # differences of each discard and the indices of the discards still
+        # in the running.
+        budget = len(splits) * self.trials
+        n_rounds = max(1, ceil(log2(len(splits))))
+        z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+        points = [np.zeros(0) for _ in splits]
+        alive = list(range(len(splits)))
+        used = 0
+
+        self.rollouts_saved = 0
+        for r in range(n_rounds):
+            if r == n_rounds - 1 or len(alive) <= 2:
+                # the last round spends what is left of the budget
+                trials = (budget - used) // len(alive)
+            else:
+                trials = max(MIN_ROUND_TRIALS,
+                             budget // (n_rounds * len(alive)))
+                trials = min(trials, (budget - used) // len(alive))
+            if trials < 1:
+                break
+            new_points = self.rollouts(
+                hand, dealer, n_players, [splits[k] for k in alive], trials)
+            used += new_points.size
+            for k, p in zip(alive, new_points):
+                points[k] = np.concatenate([points[k], p])
+
+            means = np.array([points[k].mean() for k in alive])
+            best = means.argmax()
+
+            # stop when the best discard is separated from all the others.
+            # with common random numbers the trials of all discards share
+            # their deals, so the differences with the best one are compared.
+            if self.common_random_numbers:
+                diffs = [points[k] - points[alive[best]] for k in alive]
+                upper = np.array([_upper_bound(d, z) for d in diffs])
+                separated = np.delete(upper, best) < 0
+            else:
+                upper = np.array([_upper_bound(points[k], z) for k in alive])
+                lower = means[best] - (upper[best] - means[best])
+                separated = np.delete(upper, best) < lower
+            if separated.all():
+                alive = [alive[best]]
+                self.rollouts_saved = budget - used
+                break
+
+            # keep the best half
+            order = np.argsort(-means, kind="stable")
+            alive = [alive[k] for k in sorted(order[:ceil(len(alive) / 2)])]
+            if len(alive) == 1:
+                break
+
+        return points, alive
+
+    def score_hand(self, env, to_throw, my_strategy, opp_strategy):
+        # simulates a hand from the deal: I throw the cards in to_throw to
+        # the crib and peg with my_strategy, every other player plays
+        # opp_strategy. returns my points minus the other players' points
+        to_throw = list(to_throw)
         reward_diff = 0
-        state = env.state
-        prev_phase = None
         while True:
-            if state.phase == 0:
-                if state.hand_id == self.player_num:
-                    if card1 is not None:
-                        state, reward, done, debug = env.step(card1)
-                        card1 = None
-                    else:
-                        state, reward, done, debug = env.step(card2)
-                    if env.dealer == self.player_num:
-                        reward_diff += reward
-                    else:
-                        reward_diff -= reward
-                else:
-                    state, reward, done, debug = env.step(opp_strategy.play(env))
-                    if env.dealer == self.player_num:
-                        reward_diff += reward
-                    else:
-                        reward_diff -= reward
-            elif state.phase == 1:
-                if state.hand_id == self.player_num:
-                    state, reward, done, debug = env.step(my_strategy.play(env))
-                    reward_diff += reward
-                else:
-                    state, reward, done, debug = env.step(opp_strategy.play(env))
-                    reward_diff -= reward
+            if env.phase == 2:
+                card = None
+            elif env.player != self.player_num:
+                card = opp_strategy.play(env)
+            elif env.phase == 0:
+                card = to_throw.pop(0)
             else:
-                if state.hand_id == self.player_num:
-                    state, reward, done, debug = env.step([])
-                    reward_diff += reward
-                else:
-                    state, reward, done, debug = env.step([])
-                    reward_diff -= reward
+                card = my_strategy.play(env)
+            state, reward, done, debug = env.step(card)
+            if state.reward_id == self.player_num:
+                reward_diff += reward
+            else:
+                reward_diff -= reward
 
-            # end of a hand
-            if state.phase == 0 and prev_phase == 2:
-                return reward_diff
-            prev_phase = state.phase
-            # if game over, return reward
-            if done:
+            # end of the hand, or of the game
+            if done or env.new_hand:
                 return reward_diff
 
-    def simulate_hand(self, hand, dealer, n_players):
-        # create a totally new environment with the same cards dealt
-        new_env = CribbageEnv(n_players=n_players, verbose=False, debug=False)
-        new_env.reset(dealer=dealer)
-
-        # reset the deck
-        new_env.deck = Deck()
-        # reset hands
-        new_env.hands = [Stack() for i in range(n_players)]
-        # add my sim hand to my hand
-        new_env.hands[self.player_num] = hand
-        # remove my sim hand from the deck
-        for c in hand:
-            new_env.deck = new_env.deck.remove(c)
-        # deal cards to other players
-        for i in range(n_players):
-            for j in range(new_env._cards_per_hand):
-                # only deal to other players
-                if i != self.player_num:
-                    new_env.hands[i].add_(new_env.deck.deal(player=i))
-
-        # reset the state
-        new_env.state = State(
-            new_env.hands[dealer],
-            dealer,
-            dealer,
-            0,
-            0,
-            []
-        )
-
-        return new_env
+    def simulate_hand(self, hand, dealer, n_players, seed=None):
+        # create a totally new environment with the same cards dealt to me,
+        # and random cards to the other players
+        hands = [None] * n_players
+        hands[self.player_num] = list(hand)
+        return CribbageEnv.from_position(hands, dealer=dealer, rng=seed)
 
     
     def discard(self, env):
         # check if card to discard already calculated
         if not self.next_discard:
             t1 = datetime.datetime.now()
-            lb = np.zeros((6, 6))
-            scores = np.zeros((6, 6))
-            ub = np.zeros((6, 6))
-            hand = env.state.hand
-
-            # loop through all 2 card combinations to discard
-            hand = copy.deepcopy(env.hands[0])
+            hand = copy.deepcopy(env.hands[self.player_num])
             dealer = copy.deepcopy(env.dealer)
             if self.verbose:
                 print("Hand: {}".format(hand))
@@ -244,45 +376,237 @@ class MonteCarlo(Greedy):
 
             n_players = copy.deepcopy(env.n_players)
 
-            # get new environment
-            for i in range(5):
-                for j in range(i+1, 6):
-                    points = []
-                    card1 = hand[i]
-                    card2 = hand[j]
-                    for t in range(self.trials):
-                        new_env = self.simulate_hand(hand, dealer, n_players)
-                        # simulate
-                        my_strategy = Greedy()
-                        opp_strategy = Greedy()
-                        reward_diff = self.score_hand(new_env, card1, card2, my_strategy, opp_strategy)
-                        hand = copy.deepcopy(env.hands[0])
-                        points.append(reward_diff)
-                    scores[i][j] = np.mean(points)
-                    lb[i][j] = np.percentile(points, 5)
-                    ub[i][j] = np.percentile(points, 95)
-
-            # find 2 best cards
-            # replace non-scores with large negative number
-            scores[scores == 0] = -1000
-            discard1, discard2 = np.unravel_index(scores.argmax(), scores.shape)
-            discard1 = int(discard1)
-            discard2 = int(discard2)
+            # simulate every way to keep 4 cards (throwing 2 cards with 2
+            # players, 1 with 3 or 4), possibly in parallel
+            splits = list(combinations(hand, len(hand) - 4))
+            if self.adaptive:
+                points, alive = self.adaptive_rollouts(
+                    hand, dealer, n_players, splits)
+                if self.verbose:
+                    print("Rollouts saved: {}".format(self.rollouts_saved))
+            else:
+                points = self.rollouts(
+                    hand, dealer, n_players, splits, self.trials)
+                alive = range(len(splits))
+
+            # only discards still in the running can be picked
+            scores = np.full(len(splits), -np.inf)
+            for k in alive:
+                scores[k] = np.mean(points[k])
+
+            # find the best cards
+            best = int(scores.argmax())
+            to_throw = splits[best]
             if self.verbose:
-                print("Best play: {}, {}".format(hand[discard1], hand[discard2]))
-                print("Best play points: ({}, {}, {})".format(lb[discard1][discard2],
-                                                              scores[discard1][discard2],
-                                                              ub[discard1][discard2]))
-            self.next_discard = hand[discard2]
+                print("Best play: {}".format(", ".join(map(str, to_throw))))
+                print("Best play points: ({}, {}, {})".format(
+                    np.percentile(points[best], 5), scores[best],
+                    np.percentile(points[best], 95)))
+            if len(to_throw) > 1:
+                self.next_discard = to_throw[1]
             if self.verbose:
                 print("Time: {}".format(datetime.datetime.now() - t1))
-            return hand[discard1]
+            return to_throw[0]
         else:
             next_discard = self.next_discard
             self.next_discard = None
             return next_discard
 
 
+def _no_observation():
+    return None
+
+
+class _Node(object):
+    # statistics of a move in the ISMCTS tree. avail counts the iterations
+    # in which the move was legal, for the UCB of moves that are not always
+    # available.
+    __slots__ = ('children', 'visits', 'avail', 'total')
+
+    def __init__(self):
+        self.children = {}
+        self.visits = 0
+        self.avail = 0
+        self.total = 0.
+
+
+class ISMCTS(Player):
+    # information set monte carlo tree search, from the point of view of the
+    # player to act. each iteration deals the unseen cards at random (a
+    # determinization) and plays the rest of the hand: down the tree with
+    # UCB over the moves legal in that deal, then at random. the reward of
+    # a move is the points of its player minus the points of the others
+    # until the end of the hand. opponents' discards are hidden, so they are
+    # played at random and kept out of the tree, which is kept from one
+    # decision to the next within a hand. each decision runs `iterations`
+    # iterations, or as many as fit in `time_limit` seconds if given.
+    def __init__(self, iterations=1000, time_limit=None, exploration=0.7,
+                 seed=None):
+        self.name = 'ISMCTS'
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.exploration = exploration
+        self.rng = rand.Random(seed)
+        self.decisions = 0
+        self.search_time = 0.
+        self.total_iterations = 0
+        self._hand = None
+        self._history = None
+        self._root = None
+
+    @property
+    def decisions_per_second(self):
+        if self.search_time == 0:
+            return 0.
+        return self.decisions / self.search_time
+
+    def discard(self, env):
+        return self.search(env)
+
+    def peg(self, env):
+        return self.search(env)
+
+    def search(self, env):
+        start = time.perf_counter()
+        me = env.player
+        root = self._reuse(env, me)
+
+        n = 0
+        while True:
+            self._iterate(env, me, root)
+            n += 1
+            if self.time_limit is not None:
+                if time.perf_counter() - start >= self.time_limit:
+                    break
+            elif n >= self.iterations:
+                break
+
+        # the most visited move
+        legal = self._legal(env, me)
+        card = max(legal, key=lambda c: root.children[me, c.idx].visits
+                   if (me, c.idx) in root.children else -1)
+
+        self.decisions += 1
+        self.total_iterations += n
+        self.search_time += time.perf_counter() - start
+        return card
+
+    def _reuse(self, env, me):
+        # the node of the current position in the tree of the previous
+        # decision, if it was taken in the same hand
+        n = env.n_players
+        mine = [c for i, c in enumerate(env.crib)
+                if (env.dealer + i) % n == me]
+        owner = {c: p for p in range(n) for c in env.played[p]}
+        history = [(me, c.idx) for c in mine] + [
+            (owner[c], c.idx) for c in list(env.discarded) + list(env.table)]
+        hand = (me, env.dealer, frozenset(
+            list(env.hands[me]) + list(env.played[me]) + mine))
+
+        node = None
+        if hand == self._hand and \
+                history[:len(self._history)] == self._history:
+            node = self._root
+            for move in history[len(self._history):]:
+                node = node.children.get(move)
+                if node is None:
+                    break
+        if node is None:
+            node = _Node()
+        self._hand, self._history, self._root = hand, history, node
+        return node
+
+    def _legal(self, env, player):
+        if env.phase == 0:
+            return list(env.hands[player])
+        return [c for c in env.hands[player]
+                if env.table_value + c.value <= MAX_TABLE_VALUE]
+
+    def _determinize(self, env, me):
+        # a copy of env where the cards unseen by me are dealt at random
+        world = env.clone()
+        n = env.n_players
+        others = [p for p in range(n) if p != me]
+        slots = [i for i in range(len(world.crib))
+                 if (env.dealer + i) % n != me]
+        pool = [c for p in others for c in world.hands[p]]
+        pool += [world.crib.cards[i] for i in slots] + world.deck.cards
+        self.rng.shuffle(pool)
+
+        k = 0
+        for p in others:
+            m = len(world.hands[p])
+            world.hands[p] = Stack(pool[k:k + m])
+            k += m
+        for i in slots:
+            world.crib.cards[i] = pool[k]
+            k += 1
+        world._update_held()
+
+        world.deck.set_cards(pool[k:])
+
+        # the simulated steps do not need observations
+        world._observe = _no_observation
+        return world
+
+    def _iterate(self, env, me, root):
+        world = self._determinize(env, me)
+        start = world.scores.astype(np.int64)
+        node, path = root, []
+        while True:
+            if world.phase == 2:
+                card = None
+            else:
+                player = world.player
+                legal = self._legal(world, player)
+                if node is None or (world.phase == 0 and player != me):
+                    card = self.rng.choice(legal)
+                else:
+                    card, child, expanded = self._select(
+                        node, player, legal)
+                    points = world.scores - start
+                    path.append((child, player, 2 * points[player] -
+                                 points.sum()))
+                    node = None if expanded else child
+            _, _, done, _ = world.step(card)
+            if done or world.new_hand:
+                break
+
+        points = world.scores - start
+        total = points.sum()
+        for node, player, base in path:
+            node.visits += 1
+            node.total += 2 * points[player] - total - base
+
+    def _select(self, node, player, legal):
+        # expands a legal move not tried yet, or picks the best by UCB.
+        # returns the card, its node and whether it was just expanded (the
+        # rest of the iteration is then played at random).
+        children = node.children
+        untried = []
+        for c in legal:
+            child = children.get((player, c.idx))
+            if child is None:
+                untried.append(c)
+            else:
+                child.avail += 1
+        if untried:
+            card = self.rng.choice(untried)
+            child = children[player, card.idx] = _Node()
+            child.avail = 1
+            return card, child, True
+
+        c = self.exploration * REWARD_SCALE
+        best, best_value = None, None
+        for card in legal:
+            child = children[player, card.idx]
+            value = child.total / child.visits + c * sqrt(
+                log(child.avail) / child.visits)
+            if best is None or value > best_value:
+                best, best_value = card, value
+        return best, children[player, best.idx], False
+
+
 class Human(Player):
     # play as a human
     def __init__(self):
@@ -0,0 +1,285 @@
+"""
+Performance benchmarks. Every benchmark is seeded, so runs on different
+commits time exactly the same work:
+
+    python benchmarks/bench_cribbage.py --output bench.json
+    python benchmarks/bench_cribbage.py --compare bench.json
+
+Results are written as JSON: the time per call (best and median over the
+repeats) of each benchmark, with the commit and versions they were run on.
+"""
+import argparse
+import json
+import os
+import platform
+import random as rand
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from agents import Greedy, MonteCarlo  # noqa: E402
+from gym_cribbage.envs.cribbage_env import (  # noqa: E402
+    CARDS,
+    CribbageEnv,
+    Stack,
+    evaluate_cards,
+    evaluate_table,
+    is_sequence,
+)
+
+SEED = 0
+BENCHMARKS = {}
+
+
+def benchmark(repeat=5):
+    """
+    Registers a benchmark. The decorated function does the (untimed) setup
+    and returns (func, n_calls): func() is timed, and makes n_calls calls
+    of the benchmarked code.
+    """
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, repeat)
+        return setup
+    return register
+
+
+def _random_cards(rng, n_sets, size):
+    return [[CARDS[i] for i in rng.choice(52, size, replace=False)]
+            for _ in range(n_sets)]
+
+
+def _play(env, policy, on_step=None):
+    """Plays a game, with policy(env) choosing the cards."""
+    state, _, done, _ = env.reset()
+    while not done:
+        phase = env.phase
+        card = policy(env) if phase < 2 else None
+        state, _, done, _ = env.step(card)
+        if on_step is not None:
+            on_step(phase)
+
+
+def _first_card(env):
+    return env.state.hand[0]
+
+
+@benchmark()
+def evaluate_cards_hand():
+    hands = _random_cards(np.random.default_rng(SEED), 1000, 5)
+    hands = [(Stack(h[:4]), h[4]) for h in hands]
+
+    def run():
+        for hand, starter in hands:
+            evaluate_cards(hand, starter=starter)
+    return run, len(hands)
+
+
+@benchmark()
+def evaluate_table_play():
+    rng = np.random.default_rng(SEED)
+    tables = [c for n in rng.integers(1, 9, 1000)
+              for c in _random_cards(rng, 1, n)]
+
+    def run():
+        for table in tables:
+            evaluate_table(table)
+    return run, len(tables)
+
+
+@benchmark()
+def is_sequence_cards():
+    rng = np.random.default_rng(SEED)
+    cards = [c for n in rng.integers(3, 8, 1000)
+             for c in _random_cards(rng, 1, n)]
+
+    def run():
+        for c in cards:
+            is_sequence(c)
+    return run, len(cards)
+
+
+@benchmark()
+def stack_state():
+    stacks = [Stack(h) for h in
+              _random_cards(np.random.default_rng(SEED), 1000, 6)]
+
+    def run():
+        for s in stacks:
+            s.state
+    return run, len(stacks)
+
+
+@benchmark()
+def stack_compact_state():
+    stacks = [Stack(h) for h in
+              _random_cards(np.random.default_rng(SEED), 1000, 6)]
+
+    def run():
+        for s in stacks:
+            s.compact_state
+    return run, len(stacks)
+
+
+def _step_benchmark(phase):
+    env = CribbageEnv()
+    counts = [0, 0, 0]
+
+    def count(p):
+        counts[p] += 1
+    env.seed(SEED)
+    for _ in range(20):
+        _play(env, _first_card, count)
+
+    def run():
+        # Only the steps of the given phase are timed.
+        env.seed(SEED)
+        elapsed = 0.
+        for _ in range(20):
+            state, _, done, _ = env.reset()
+            while not done:
+                p = env.phase
+                card = env.state.hand[0] if p < 2 else None
+                if p == phase:
+                    t = time.perf_counter()
+                    state, _, done, _ = env.step(card)
+                    elapsed += time.perf_counter() - t
+                else:
+                    state, _, done, _ = env.step(card)
+        return elapsed
+    return run, counts[phase]
+
+
+@benchmark()
+def step_deal():
+    return _step_benchmark(0)
+
+
+@benchmark()
+def step_play():
+    return _step_benchmark(1)
+
+
+@benchmark()
+def step_show():
+    return _step_benchmark(2)
+
+
+@benchmark()
+def full_game():
+    env = CribbageEnv()
+
+    def run():
+        env.seed(SEED)
+        for _ in range(10):
+            _play(env, _first_card)
+    return run, 10
+
+
+@benchmark()
+def greedy_peg():
+    # Positions of the Play, reached by discarding the first cards.
+    env = CribbageEnv()
+    env.seed(SEED)
+    positions = []
+    while len(positions) < 200:
+        state, _, done, _ = env.reset()
+        while not done and len(positions) < 200:
+            if env.phase == 1:
+                positions.append(env.snapshot())
+            card = env.state.hand[0] if env.phase < 2 else None
+            state, _, done, _ = env.step(card)
+    agent = Greedy()
+
+    def run():
+        for snap in positions:
+            env.restore(snap)
+            agent.peg(env)
+    return run, len(positions)
+
+
+@benchmark(repeat=3)
+def monte_carlo_discard():
+    env = CribbageEnv()
+    deals = []
+    for seed in range(3):
+        env.reset(dealer=seed % 2, seed=SEED + seed)
+        deals.append(env.snapshot())
+
+    def run():
+        rand.seed(SEED)
+        agent = MonteCarlo(trials=10, seed=SEED)
+        for snap in deals:
+            env.restore(snap)
+            agent.next_discard = None
+            agent.discard(env)
+    return run, len(deals)
+
+
+def run_benchmarks(names=None):
+    results = {}
+    for name, (setup, repeat) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        func, n_calls = setup()
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            elapsed = func()
+            # The step benchmarks only time the steps themselves.
+            times.append(elapsed if elapsed is not None else
+                         time.perf_counter() - t)
+        results[name] = {
+            "calls": n_calls,
+            "repeat": repeat,
+            "best": min(times) / n_calls,
+            "median": statistics.median(times) / n_calls,
+        }
+        print("{:24s} {:12.2f} us/call".format(
+            name, 1e6 * results[name]["best"]))
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("names", nargs="*", help="benchmarks to run")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare",
+                        help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names)
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": SEED,
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["benchmarks"]
+        print("\nCompared with {}:".format(args.compare))
+        for name, result in results.items():
+            if name in baseline:
+                print("{:24s} {:+7.1%}".format(
+                    name, result["best"] / baseline[name]["best"] - 1))
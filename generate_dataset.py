@@ -0,0 +1,213 @@
+from gym_cribbage.envs.cribbage_env import CribbageEnv, OBS_SCORES
+import agents
+import argparse
+import inspect
+import multiprocessing
+import numpy as np
+import os
+import queue as queues
+import random as rand
+import traceback
+
+
+# one row per step of the environment. during the show nobody acts: the
+# action is -1 and the mask is empty.
+FIELDS = {
+    'obs': np.int16,     # observation of the player to act, see OBS_*
+    'mask': bool,        # legal actions, over Card.idx
+    'action': np.int8,   # Card.idx played or discarded
+    'reward': np.int16,
+    'scorer': np.int8,   # player who got the reward
+    'player': np.int8,   # player who acted
+    'done': bool,
+    'game': np.int64,
+}
+
+
+def _buffers(size, n_players):
+    # preallocated arrays holding `size` rows
+    shapes = {'obs': (OBS_SCORES + n_players,), 'mask': (52,)}
+    return {k: np.zeros((size,) + shapes.get(k, ()), dtype=dtype)
+            for k, dtype in FIELDS.items()}
+
+
+def _new_agent(player, seat):
+    # agents that depend on their seat (e.g. MonteCarlo) take a player_num
+    if 'player_num' in inspect.signature(player).parameters:
+        return player(player_num=seat)
+    return player()
+
+
+def self_play(players, games, seeds, chunk_size=4096):
+    # plays the games with the given agent classes (one per seat, created
+    # at the start of each game) and yields the steps in chunks of at most
+    # chunk_size rows. games are global game ids, seeds their SeedSequences.
+    # the agents draw from the random module, which is seeded for each game:
+    # its state is swapped with the caller's while the chunks are yielded.
+    n_players = len(players)
+    env = CribbageEnv(n_players=n_players, array_obs=True)
+    chunk = _buffers(chunk_size, n_players)
+    n = 0
+    other_state = rand.getstate()
+    try:
+        for game, game_seed in zip(games, seeds):
+            rand.seed(int(game_seed.generate_state(1)[0]))
+            seats = [_new_agent(player, seat)
+                     for seat, player in enumerate(players)]
+            obs, _, done, _ = env.reset(seed=game_seed)
+            while not done:
+                chunk['obs'][n] = obs
+                chunk['mask'][n] = env.legal_action_mask()
+                chunk['player'][n] = env.player
+                if env.phase < 2:
+                    card = seats[env.player].play(env)
+                    chunk['action'][n] = card.idx
+                else:
+                    card = None
+                    chunk['action'][n] = -1
+                obs, reward, done, _ = env.step(card)
+                chunk['reward'][n] = reward
+                chunk['scorer'][n] = env.reward_id
+                chunk['done'][n] = done
+                chunk['game'][n] = game
+                n += 1
+                if n == chunk_size:
+                    game_state = rand.getstate()
+                    rand.setstate(other_state)
+                    yield chunk
+                    other_state = rand.getstate()
+                    rand.setstate(game_state)
+                    chunk = _buffers(chunk_size, n_players)
+                    n = 0
+    except Exception:
+        rand.setstate(other_state)
+        raise
+    rand.setstate(other_state)
+    if n:
+        yield {k: v[:n] for k, v in chunk.items()}
+
+
+def _worker(queue, players, games, seeds, chunk_size):
+    # put() blocks while the queue is full, so the workers cannot get more
+    # than max_pending chunks each ahead of the writer.
+    try:
+        for chunk in self_play(players, games, seeds, chunk_size):
+            queue.put(chunk)
+        queue.put(None)
+    except Exception:
+        queue.put(traceback.format_exc())
+
+
+class ShardWriter(object):
+    # packs rows into shards of exactly shard_size rows (except the last
+    # one), written to out_dir/shard-00000.npz, shard-00001.npz, ...
+    def __init__(self, out_dir, shard_size, n_players, compress=False):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.compress = compress
+        self.buffers = _buffers(shard_size, n_players)
+        self.n = 0
+        self.paths = []
+
+    def add(self, chunk):
+        start, size = 0, len(chunk['done'])
+        while start < size:
+            m = min(size - start, self.shard_size - self.n)
+            for k, v in self.buffers.items():
+                v[self.n:self.n + m] = chunk[k][start:start + m]
+            self.n += m
+            start += m
+            if self.n == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if self.n == 0:
+            return
+        path = os.path.join(
+            self.out_dir, 'shard-{:05d}.npz'.format(len(self.paths)))
+        save = np.savez_compressed if self.compress else np.savez
+        save(path, **{k: v[:self.n] for k, v in self.buffers.items()})
+        self.paths.append(path)
+        self.n = 0
+
+
+def generate_dataset(out_dir, n_games, players=(agents.Greedy, agents.Greedy),
+                     n_workers=1, seed=None, shard_size=100000,
+                     chunk_size=4096, max_pending=8, compress=False,
+                     poll_interval=1.):
+    # self-play of n_games between the agent classes in players (one per
+    # seat) spread over n_workers processes. the steps are streamed to
+    # shards of shard_size rows, see FIELDS. at most max_pending chunks per
+    # worker wait in memory before the workers are made to wait. each game
+    # has its own seed, so the games do not depend on n_workers. the
+    # workers are checked every poll_interval seconds without a chunk, and
+    # a RuntimeError is raised if one of them died.
+    # returns the paths of the shards.
+    writer = ShardWriter(out_dir, shard_size, len(players), compress)
+    seeds = np.random.SeedSequence(seed).spawn(n_games)
+    games = np.array_split(np.arange(n_games), n_workers)
+
+    if n_workers == 1:
+        for chunk in self_play(players, games[0], seeds, chunk_size):
+            writer.add(chunk)
+        writer.flush()
+        return writer.paths
+
+    ctx = multiprocessing.get_context()
+    queue = ctx.Queue(maxsize=max_pending * n_workers)
+    workers = [ctx.Process(target=_worker, args=(
+        queue, players, g, seeds[g[0]:g[-1] + 1], chunk_size))
+        for g in games if len(g)]
+    for w in workers:
+        w.start()
+
+    try:
+        running = len(workers)
+        while running:
+            try:
+                chunk = queue.get(timeout=poll_interval)
+            except queues.Empty:
+                # a worker killed (e.g. out of memory) never sends its
+                # sentinel
+                for w in workers:
+                    if w.exitcode:
+                        raise RuntimeError(
+                            'Worker {} exited with code {}'.format(
+                                w.pid, w.exitcode))
+                continue
+            if chunk is None:
+                running -= 1
+            elif isinstance(chunk, str):
+                raise RuntimeError('Worker failed:\n' + chunk)
+            else:
+                writer.add(chunk)
+        writer.flush()
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+
+    return writer.paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a self-play dataset in npz shards.')
+    parser.add_argument('out_dir')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--players', nargs='+', default=['Greedy', 'Greedy'],
+                        help='agent class names from agents.py, one per seat')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=100000)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    paths = generate_dataset(
+        args.out_dir, args.games,
+        players=[getattr(agents, name) for name in args.players],
+        n_workers=args.workers, seed=args.seed, shard_size=args.shard_size,
+        compress=args.compress)
+    print('Wrote {} shards to {}'.format(len(paths), args.out_dir))
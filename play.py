@@ -1,5 +1,6 @@
 from gym_cribbage.envs.cribbage_env import CribbageEnv, evaluate_cards, Deck, Card
 from agents import *
+import argparse
 import numpy as np
 import random as rand
 import pandas as pd
@@ -8,135 +9,98 @@ import copy
 import pprint
 
 
+# one row per hand and seat
+COLUMNS = ['game_id', 'hand', 'seat', 'player', 'dealer',
+           'deal', 'play', 'show', 'score', 'done']
+
+
+def play_game(game_id, env, players, verbose=False):
+    # plays a game between players, one agent per seat of env (2 to 4), and
+    # returns the log as {column: list}, see COLUMNS. the points of a step
+    # go to the seat in env.reward_id, in the column of the phase it was
+    # played in: the deal (the dealer's heels), the play or the show.
+    if len(players) != env.n_players:
+        raise ValueError("{} players for a {} player game".format(
+            len(players), env.n_players))
 
-def play_game(game_id, env, p1, p2):
     # need to manually turn off logging for some reason
     env.logger.setLevel(logging.NOTSET)
 
     # new game
     state, reward, done, debug = env.reset()
-    
+
     # initialize game logger
-    logger = {
-        'game_id': [],
-        'player1': [],
-        'player2': [],
-        'dealer': [],
-        'p1_deal': [],
-        'p2_deal': [],
-        'p1_play': [],
-        'p2_play': [],
-        'p1_show': [],
-        'p2_show': [],
-        'p1_score': [],
-        'p2_score': [],
-        'done': []
-    }
-    
-    # initialize hand logger
-    hand_logger = {
-        'game_id': game_id,
-        'player1': p1.name,
-        'player2': p2.name,
-        'dealer': env.dealer,
-        'p1_deal': 0,
-        'p2_deal': 0,
-        'p1_play': 0,
-        'p2_play': 0,
-        'p1_show': 0,
-        'p2_show': 0,
-        'p1_score': 0,
-        'p2_score': 0,
-        'done': False
-    }
-    
-    prev_phase = None
-    while True:
-        if state.phase == 0:
-            if state.hand_id == 0:
-                state, reward, done, debug = env.step(p1.play(env))
-                if env.dealer == 0:
-                    hand_logger['p1_deal'] += reward
-                else:
-                    hand_logger['p2_deal'] += reward
-            else:
-                state, reward, done, debug = env.step(p2.play(env))
-                if env.dealer == 0:
-                    hand_logger['p1_deal'] += reward
-                else:
-                    hand_logger['p2_deal'] += reward
-        elif state.phase == 1:
-            if state.hand_id == 0:
-                state, reward, done, debug = env.step(p1.play(env))
-                hand_logger['p1_play'] += reward
-            else:
-                state, reward, done, debug = env.step(p2.play(env))
-                hand_logger['p2_play'] += reward
-        else:
-            if state.hand_id == 0:
-                state, reward, done, debug = env.step([])
-                hand_logger['p1_show'] += reward
-            else:
-                state, reward, done, debug = env.step([])
-                hand_logger['p2_show'] += reward
-        
-        # end of a hand
-        if state.phase == 0 and prev_phase == 2:
-            p1_hand = hand_logger['p1_deal'] + hand_logger['p1_play'] + hand_logger['p1_show']
-            p2_hand = hand_logger['p2_deal'] + hand_logger['p2_play'] + hand_logger['p2_show']            
-            print("Score Diff: {}".format(p1_hand - p2_hand))
-            hand_logger['p1_score'] = env.scores[0]
-            hand_logger['p2_score'] = env.scores[1]
-            pprint.pprint(hand_logger)
-            
-            # add to logger
-            for key, value in hand_logger.items():
-                logger[key].append(value)
-            
-            # reset hand logger
-            hand_logger = {
-                'game_id': game_id,
-                'player1': p1.name,
-                'player2': p2.name,
-                'dealer': env.dealer,
-                'p1_deal': 0,
-                'p2_deal': 0,
-                'p1_play': 0,
-                'p2_play': 0,
-                'p1_show': 0,
-                'p2_show': 0,
-                'p1_score': 0,
-                'p2_score': 0,
-                'done': False
-            }
-        prev_phase = state.phase
-        
-        if done:
-            hand_logger['p1_score'] = env.scores[0]
-            hand_logger['p2_score'] = env.scores[1]
+    logger = {key: [] for key in COLUMNS}
+    phases = ['deal', 'play', 'show']
+    hand = 0
+
+    # initialize hand logger, one per seat
+    def new_hands():
+        return [{'game_id': game_id,
+                 'hand': hand,
+                 'seat': seat,
+                 'player': player.name,
+                 'dealer': env.dealer == seat,
+                 'deal': 0,
+                 'play': 0,
+                 'show': 0,
+                 'score': 0,
+                 'done': False} for seat, player in enumerate(players)]
+
+    def log_hands(hand_loggers):
+        for seat, hand_logger in enumerate(hand_loggers):
+            hand_logger['score'] = int(env.scores[seat])
             hand_logger['done'] = done
-            
-            # add to logger
             for key, value in hand_logger.items():
                 logger[key].append(value)
-            
-            return logger
+        if verbose:
+            pprint.pprint(hand_loggers)
+
+    hand_loggers = new_hands()
+    while not done:
+        phase = env.phase
+        if phase == 2:
+            card = None
+        else:
+            card = players[env.player].play(env)
+        state, reward, done, debug = env.step(card)
+        hand_loggers[env.reward_id][phases[phase]] += reward
+
+        # end of a hand
+        if env.new_hand:
+            log_hands(hand_loggers)
+            hand += 1
+            hand_loggers = new_hands()
+
+    log_hands(hand_loggers)
+    return logger
 
 
 if __name__ == '__main__':
-    env = CribbageEnv(verbose=False)
-    p1 = MonteCarlo(player_num=0, trials=100, verbose=True)
-    p2 = Greedy()
-
-    df = pd.DataFrame()
-
-    # play 1000 games
-    for g in range(100):
-        print(g)
-        logger = play_game(g, env, p1, p2)
-        logger_df = pd.DataFrame.from_dict(logger)
-        df = df.append(logger_df)
-        print(df.tail(1)[['p1_score', 'p2_score']])
-
-    df = df.reset_index()
-    df.to_csv("~/Desktop/mc_game-100.csv", index=False)
+    parser = argparse.ArgumentParser(
+        description='Play a tournament between agents from agents.py.')
+    parser.add_argument('--players', nargs='+',
+                        default=['MonteCarlo', 'Greedy'],
+                        help='agent class names, one per seat (2 to 4)')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--output', default='games.csv')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    env = CribbageEnv(n_players=len(args.players), verbose=False)
+    players = []
+    for seat, name in enumerate(args.players):
+        if name == 'MonteCarlo':
+            players.append(MonteCarlo(player_num=seat, trials=100,
+                                      verbose=args.verbose))
+        else:
+            players.append(globals()[name]())
+
+    logs = []
+    for g in range(args.games):
+        logger = play_game(g, env, players, verbose=args.verbose)
+        logs.append(pd.DataFrame.from_dict(logger))
+        print(g, logs[-1].tail(len(players))['score'].tolist())
+
+    df = pd.concat(logs, ignore_index=True)
+    df.to_csv(args.output, index=False)
@@ -5,12 +5,27 @@
 # @Last Modified time: 2019-03-22 19:51:20
 
 from copy import copy
-from itertools import product, combinations
+from itertools import combinations, combinations_with_replacement
 import gym
 import logging
 import numpy as np
-import random
 from collections import defaultdict
+from functools import lru_cache
+
+from gym_cribbage.envs.trace import (
+    Discard,
+    Go,
+    NewGame,
+    NewHand,
+    Play,
+    ResetTable,
+    Show,
+    Skip,
+    StartShow,
+    Starter,
+    Trace,
+)
+from gym_cribbage.envs.timings import Timings
 
 SUITS = "♤♡♧♢"
 RANKS = ["A", 2, 3, 4, 5, 6, 7, 8, 9, 10, "J", "Q", "K"]
@@ -18,6 +33,7 @@ RANKS = ["A", 2, 3, 4, 5, 6, 7, 8, 9, 10, "J", "Q", "K"]
 # Starting the idx at 1 because 0 will be used as padding
 RANK_TO_IDX = {r: i for i, r in enumerate(RANKS, 1)}
 SUIT_TO_IDX = {s: i for i, s in enumerate(SUITS, 1)}
+JACK = RANKS.index("J")
 
 # Render: Used to render player-specific stats.
 TABLE_MP = """--- Player1 Player2 Player3 Player4
@@ -35,6 +51,27 @@ ROW = "{:12s} {:60s}"
 
 MAX_TABLE_VALUE = 31  # Max points allowed before hand reset.
 MAX_ROUND_VALUE = 121  # Max points allowed before game ends.
+# Highest score: one point from winning, the dealer shows a hand and the crib
+# in the same step, each worth at most 29 points.
+MAX_SCORE = MAX_ROUND_VALUE - 1 + 2 * 29
+
+# Array observations, from the current player's point of view.
+OBS_HAND = slice(0, 52)  # Cards in the current player's hand.
+OBS_TABLE = slice(52, 104)  # Cards on the table for the current count.
+OBS_PLAYED = slice(104, 156)  # Cards played in earlier counts of this hand.
+OBS_STARTER = slice(156, 208)  # The starter, once it is drawn.
+OBS_PHASE = 208
+OBS_TABLE_VALUE = 209
+OBS_DEALER = 210  # 1 if the current player is the dealer.
+OBS_SCORES = 211  # Scores, starting with the current player's.
+
+# Bit i of a hand mask is set when the hand holds CARDS[i].
+_BIT_SHIFTS = np.arange(52, dtype=np.uint64)
+
+# Methods of CribbageEnv timed by enable_timings().
+TIMED = ("step", "_step_deal", "_step_play", "_step_show", "_reset_hand",
+         "_evaluate_play", "_evaluate_show", "_count_playable_cards",
+         "_next_avail_player", "_new_deck")
 
 # For debug information.
 logging.basicConfig(
@@ -42,42 +79,37 @@ logging.basicConfig(
 
 
 class Card(object):
-    """Card, french style"""
+    """
+    Card, french style. There are only 52 cards: Card(rank, suit) returns the
+    interned instance, identified by its index in [0, 52) (see Card.idx).
+    """
 
-    def __init__(self, rank, suit, player=None):
-        super(Card, self).__init__()
-        self.rank = rank
-        self.suit = suit
-        self.player = player
+    __slots__ = ("idx", "rank", "suit", "value", "rank_value")
 
-    @property
-    def value(self):
-        if isinstance(self.rank, str):
-            if self.rank == "A":
-                return 1
-            if self.rank in "JQK":
-                return 10
-        return self.rank
+    def __new__(cls, rank, suit, player=None):
+        try:
+            return CARDS[_CARD_TO_IDX[rank, suit]]
+        except (KeyError, TypeError):
+            raise ValueError("{}{} is not a card".format(rank, suit))
+
+    @classmethod
+    def _intern(cls, idx):
+        card = object.__new__(cls)
+        card.idx = idx
+        card.rank, card.suit = cls.rank_suit_from_idx(idx)
+        card.value = CARD_VALUES[idx]
+        card.rank_value = CARD_RANK_VALUES[idx]
+        return card
 
-    @property
-    def rank_value(self):
-        if self.rank == "A":
-            return 1
-        elif self.rank == 'J':
-            return 11
-        elif self.rank == 'Q':
-            return 12
-        elif self.rank == 'K':
-            return 13
-
-        return self.rank
+    @staticmethod
+    def from_idx(idx):
+        return CARDS[idx]
 
     @property
     def state(self):
         # One-hot encode the card
         s = np.zeros(52)
-        idx = SUITS.index(self.suit) * 13 + RANKS.index(self.rank)
-        s[idx] = 1
+        s[self.idx] = 1
         return s
 
     @property
@@ -85,8 +117,8 @@ class Card(object):
         # [0:3] encode suit, [4:16] encode rank
         suit = np.zeros(4)
         rank = np.zeros(13)
-        suit[SUITS.index(self.suit)] = 1
-        rank[RANKS.index(self.rank)] = 1
+        suit[self.idx // 13] = 1
+        rank[self.idx % 13] = 1
         return suit, rank
 
     @staticmethod
@@ -101,8 +133,22 @@ class Card(object):
     def __str__(self):
         return "{}{}".format(self.rank, self.suit)
 
+    # Cards are singletons, copies and pickles resolve to the same instance.
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (Card.from_idx, (self.idx,))
+
     def __eq__(self, card):
-        return self.rank == card.rank and self.suit == card.suit
+        return self is card or (isinstance(card, Card) and
+                                self.idx == card.idx)
+
+    def __hash__(self):
+        return self.idx
 
     def __ge__(self, card):
         return self.rank_value >= card.rank_value
@@ -117,42 +163,100 @@ class Card(object):
         return self.rank_value < card.rank_value
 
 
+# Value (for counting to 15 and 31) and rank value (for runs) of each card.
+CARD_RANK_VALUES = tuple(RANK_TO_IDX[RANKS[i % 13]] for i in range(52))
+CARD_VALUES = tuple(min(v, 10) for v in CARD_RANK_VALUES)
+
+CARDS = tuple(Card._intern(i) for i in range(52))
+_CARD_TO_IDX = {(c.rank, c.suit): c.idx for c in CARDS}
+
+# PLAYABLE_BITS[v]: mask of the cards worth at most v, i.e. the cards that
+# can be played when the table is at MAX_TABLE_VALUE - v.
+PLAYABLE_BITS = tuple(
+    sum(1 << i for i in range(52) if CARD_VALUES[i] <= v)
+    for v in range(MAX_TABLE_VALUE + 1))
+
+
 class Deck(object):
-    """Deck of 52 cards. Automatically suffles at creation."""
+    """
+    Deck of 52 cards. Automatically suffles at creation, with the given
+    numpy.random.Generator, or the global numpy random state.
 
-    def __init__(self):
+    The deck is a permutation of card indices with a cursor: cards before the
+    cursor are dealt (or removed), cards after it are still in the deck.
+    """
+
+    def __init__(self, rng=None):
         super(Deck, self).__init__()
-        self.cards = [Card(rank, suit) for rank, suit in product(RANKS, SUITS)]
+        self.rng = np.random if rng is None else rng
+        self._order = self.rng.permutation(52)
+        # Position of each card index in self._order.
+        self._pos = np.empty(52, dtype=np.int64)
+        self._pos[self._order] = np.arange(52)
+        self._cursor = 0
 
-        random.shuffle(self.cards)
+    @property
+    def cards(self):
+        """The cards still in the deck, in dealing order."""
+        return [CARDS[i] for i in self._order[self._cursor:]]
 
     def deal(self, player=None):
         """
-        Deals a card. Optionally tell what player is getting this card
+        Deals a card. Cards are shared singletons, so player is not recorded
+        on the card.
         """
-        try:
-            card = self.cards.pop(0)
-            card.player = player
-            return card
-        except IndexError:
+        if self._cursor == 52:
             return None
+        card = CARDS[self._order[self._cursor]]
+        self._cursor += 1
+        return card
+
+    def shuffle(self):
+        """Shuffles the cards still in the deck."""
+        self.rng.shuffle(self._order[self._cursor:])
+        self._pos[self._order] = np.arange(52)
+
+    def copy(self):
+        new_deck = Deck.__new__(Deck)
+        new_deck.rng = self.rng
+        new_deck._order = self._order.copy()
+        new_deck._pos = self._pos.copy()
+        new_deck._cursor = self._cursor
+        return new_deck
 
     def remove(self, card):
-        new_cards = []
-        for c in self.cards:
-            if c != card:
-                new_cards.append(c)
-        new_deck = Deck()
-        new_deck.cards = new_cards
+        new_deck = self.copy()
+        new_deck.remove_(card)
         return new_deck
 
     def remove_(self, card):
-        for i, c in enumerate(self.cards):
-            if c == card:
-                self.cards.pop(i)
+        """
+        Takes a known card out of the deck in O(1) by swapping it with the
+        next card to be dealt. Does nothing if the card was already dealt.
+        """
+        pos = self._pos[card.idx]
+        if pos < self._cursor:
+            return
+        top = self._order[self._cursor]
+        self._order[pos], self._order[self._cursor] = top, card.idx
+        self._pos[top], self._pos[card.idx] = pos, self._cursor
+        self._cursor += 1
+
+    def set_cards(self, cards):
+        """
+        Makes cards, in this order, the cards still in the deck (see
+        Deck.cards). All the other cards count as dealt.
+        """
+        rest = [c.idx for c in cards]
+        dealt = np.ones(52, dtype=bool)
+        dealt[rest] = False
+        self._order = np.concatenate([np.flatnonzero(dealt), rest]).astype(
+            np.int64)
+        self._pos[self._order] = np.arange(52)
+        self._cursor = 52 - len(rest)
 
     def __len__(self):
-        return len(self.cards)
+        return 52 - self._cursor
 
 
 class Stack(object):
@@ -170,10 +274,10 @@ class Stack(object):
             self.cards = cards
 
     def play(self, card):
-        for i, c in enumerate(self.cards):
-            if card == c:
-                return self.cards.pop(i)
-        raise ValueError("{} not in hand. Cannot play this".format(card))
+        try:
+            return self.cards.pop(self.cards.index(card))
+        except ValueError:
+            raise ValueError("{} not in hand. Cannot play this".format(card))
 
     def discard(self, card):
         """
@@ -185,8 +289,7 @@ class Stack(object):
     def state(self):
         # One-hot encode the hand
         s = np.zeros(52)
-        for card in self.cards:
-            s += card.state
+        s[[card.idx for card in self.cards]] = 1
         return s
 
     @property
@@ -220,12 +323,12 @@ class Stack(object):
     def remove(self, card):
         if not isinstance(card, Card):
             raise ValueError("Can only add card to a hand.")
-        return Stack(cards=[c for c in self.cards if c != card])
+        return Stack(cards=[c for c in self.cards if c is not card])
 
     def remove_(self, card):
         if not isinstance(card, Card):
             raise ValueError("Can only add card to a hand.")
-        self.cards = [c for c in self.cards if c != card]
+        self.cards = [c for c in self.cards if c is not card]
 
     def __repr__(self):
         if len(self.cards) == 0:
@@ -246,6 +349,70 @@ class Stack(object):
         return self.cards[idx]
 
 
+class PeggingState(object):
+    """
+    Incremental version of evaluate_table() for The Play. Keeps the running
+    count, the number of cards of the same rank at the end of the table and
+    the ranks of the last cards, so each card is scored in constant time.
+    """
+
+    __slots__ = ("count", "streak", "ranks")
+
+    # A-7 is the longest run that fits under 31.
+    MAX_RUN = 7
+    PAIR_POINTS = (0, 0, 2, 6, 12)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.streak = 0
+        # Rank values of the last MAX_RUN cards, most recent first.
+        self.ranks = []
+
+    def copy(self):
+        new_state = PeggingState.__new__(PeggingState)
+        new_state.count = self.count
+        new_state.streak = self.streak
+        new_state.ranks = list(self.ranks)
+        return new_state
+
+    def play(self, card):
+        """Adds the card to the table, returns the points it earns."""
+        rank = card.rank_value
+        ranks = self.ranks
+
+        self.count += card.value
+        self.streak = self.streak + 1 if ranks and ranks[0] == rank else 1
+        ranks.insert(0, rank)
+        del ranks[self.MAX_RUN:]
+
+        points = 2 if self.count == 15 else 0
+        points += self.PAIR_POINTS[self.streak]
+        points += _run_length(ranks)
+
+        return points
+
+
+def _run_length(ranks):
+    """
+    Length of the run at the end of the table, given the rank values of the
+    last cards, most recent first. 0 if there is no run.
+    """
+    # Grow a bitmask of the last ranks, a run is a window whose bits are all
+    # distinct and contiguous.
+    mask, run = 0, 0
+    for length, r in enumerate(ranks, 1):
+        bit = 1 << r
+        if mask & bit:
+            break
+        mask |= bit
+        if length >= 3 and (mask // (mask & -mask)) == (1 << length) - 1:
+            run = length
+    return run
+
+
 class State(object):
     """
     Contains the state of the current hand. The state tells the external world:
@@ -265,6 +432,19 @@ class State(object):
         self.opponent_score = opponent_score
 
 
+class Snapshot(object):
+    """
+    Saved state of a CribbageEnv, see CribbageEnv.snapshot(). Cards are
+    immutable, so stacks are saved as tuples of cards and only copied back
+    into new stacks when the snapshot is restored.
+    """
+
+    __slots__ = ("hands", "held", "played", "table", "crib", "starter",
+                 "discarded", "deck", "scores", "dealer", "player",
+                 "last_player", "table_value", "pegging", "phase",
+                 "prev_phase", "new_hand", "initialized", "reward_id")
+
+
 class CribbageEnv(gym.Env):
     """
     Cribbage class calculates the points during the pegging phase.
@@ -274,7 +454,8 @@ class CribbageEnv(gym.Env):
     of point following the last card played. TODO: The
     """
 
-    def __init__(self, n_players=2, verbose=False, debug=False):
+    def __init__(self, n_players=2, verbose=False, debug=False,
+                 array_obs=False):
         super(CribbageEnv, self).__init__()
 
         self.n_players = n_players
@@ -286,21 +467,263 @@ class CribbageEnv(gym.Env):
             self._cards_per_hand = 6
         else:
             self._cards_per_hand = 5
+        self._crib_size = n_players * (self._cards_per_hand - 4)
 
         self.logger = logging.getLogger(__name__)
 
         if debug:
             self.logger.setLevel(logging.DEBUG)
 
+        # Game events are only recorded when tracing, see enable_trace().
+        self.trace = None
+        if verbose or debug:
+            self.enable_trace(echo=self._echo)
+
+        # Writes the games played, see record().
+        self.recorder = None
+
+        # Time spent in each part of step(), see enable_timings().
+        self.timings = None
+
+        # Observations: State objects, or with array_obs=True, a fixed
+        # layout array (see OBS_*) written in a reusable buffer.
+        self.array_obs = array_obs
+        self.observation_space = gym.spaces.Box(
+            0, MAX_SCORE, (OBS_SCORES + n_players,), np.int16)
+        self.action_space = gym.spaces.Discrete(52)
+        self._obs = np.zeros(OBS_SCORES + n_players, dtype=np.int16)
+        self._opponents = [
+            np.array([j for j in range(n_players) if j != i])
+            for i in range(n_players)]
+        # All the players, starting from each player.
+        self._seats = [np.roll(np.arange(n_players), -i)
+                       for i in range(n_players)]
+        self._state = None
+
+        self.seed()
         self.initialized = False
 
-    def reset(self, dealer=None):
+    @property
+    def state(self):
+        """The State of the current player, built when first asked for."""
+        if self._state is None:
+            if self.phase == 0:
+                hand = Stack(list(self.hands[self.player]))
+            elif self.phase == 1:
+                playable = self._playable(self.player)
+                hand = Stack([c for c in self.hands[self.player]
+                              if playable >> c.idx & 1])
+            else:
+                hand = Stack([])
+            player_score, opponent_scores = self._get_scores()
+            self._state = State(hand, self.player, self._reward_id,
+                                self.phase, player_score, opponent_scores)
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+
+    @property
+    def reward_id(self):
         """
-        Resets the hand, additionally clearing the scoreboard.
+        The player who got the points of the last step, i.e.
+        state.reward_id without building the State.
         """
-        self.logger.debug("New Game!")
-        if self.verbose:
-            print("GAME\tNew Game!")
+        return self._reward_id
+
+    def legal_action_mask(self):
+        """
+        The cards (see Card.idx) the current player is allowed to play, as
+        an array of 52 booleans. Nothing is played during The Show.
+        """
+        if self.phase == 0:
+            bits = self._held[self.player]
+        elif self.phase == 1:
+            bits = self._playable(self.player)
+        else:
+            bits = 0
+        return (np.uint64(bits) >> _BIT_SHIFTS & np.uint64(1)).astype(bool)
+
+    def observation(self):
+        """
+        The observation of the current player as an array (see OBS_*).
+        The same buffer is reused by every call, copy it to keep it.
+        """
+        obs = self._obs
+        cards = [OBS_HAND.start + c.idx for c in self.hands[self.player]]
+        cards += [OBS_TABLE.start + c.idx for c in self.table]
+        cards += [OBS_PLAYED.start + c.idx for c in self.discarded]
+        if self.phase > 0:
+            cards.append(OBS_STARTER.start + self.starter[0].idx)
+        obs[:OBS_PHASE] = 0
+        obs[cards] = 1
+        obs[OBS_PHASE:OBS_SCORES] = (
+            self.phase, self.table_value, self.player == self.dealer)
+        obs[OBS_SCORES:] = self.scores[self._seats[self.player]]
+        return obs
+
+    def seed(self, seed=None):
+        """
+        Seeds the random generator used for shuffling and picking the
+        dealer. seed can be anything accepted by numpy.random.default_rng(),
+        e.g. an int or one of the SeedSequences returned by spawn_seeds().
+        """
+        self.rng = np.random.default_rng(seed)
+        return [seed]
+
+    @classmethod
+    def from_position(cls, hands, dealer=0, scores=None, crib=None,
+                      table=None, played=None, starter=None, phase=0,
+                      player=None, rng=None, verbose=False, debug=False):
+        """
+        Builds an environment in a given position of a hand. Known cards are
+        taken out of a shuffled deck and the unknown ones (hands given as
+        None, missing crib cards and starter) are dealt from what is left.
+
+        Params
+        ======
+            hands: list of (list of Card or None)
+                The cards in each player's hand, None if unknown. Unknown
+                hands get as many cards as the position requires. In The
+                Show, the 4 cards kept by each player, which are moved to
+                played.
+            dealer: int
+            scores: list of int
+                Score of each player, zeros by default.
+            crib: list of Card
+                Cards known to be in the crib. In The Deal, the crib
+                also tells how many cards each player discarded.
+            table: list of Card
+                Cards on the table for the current count, in order.
+            played: list of (list of Card)
+                Cards played by each player in The Play, including the
+                ones on the table.
+            starter: Card
+                In The Deal, the card that will be drawn as the starter.
+            phase: int
+                0: the deal, 1: the play, 2: the show.
+            player: int
+                The player to act. Required in The Play, unless no card
+                was played yet, and defaults to the left of the dealer
+                in The Show.
+            rng: numpy.random.Generator or seed
+
+        Raises ValueError if the position is not consistent.
+        """
+        n_players = len(hands)
+        env = cls(n_players=n_players, verbose=verbose, debug=debug)
+        env.seed(rng)
+
+        crib = list(crib or [])
+        table = list(table or [])
+        played = [list(p) for p in played] if played else [
+            [] for _ in range(n_players)]
+        hands = [list(h) if h is not None else None for h in hands]
+
+        # In The Show, every card kept was played.
+        if phase == 2:
+            for i, h in enumerate(hands):
+                if h is not None:
+                    played[i] += h
+                    hands[i] = []
+
+        # Cards each player should hold.
+        if phase == 0:
+            n_rounds, extra = divmod(len(crib), n_players)
+            n_cards = [env._cards_per_hand - n_rounds -
+                       ((i - dealer) % n_players < extra)
+                       for i in range(n_players)]
+            if player is None:
+                player = (dealer + len(crib)) % n_players
+        else:
+            n_cards = [4 - len(p) for p in played]
+            if any(n < 0 for n in n_cards):
+                raise ValueError("Players keep only 4 cards.")
+            if any(h is not None and len(h) != n
+                   for h, n in zip(hands, n_cards)):
+                raise ValueError("The hands and the played cards do not "
+                                 "add up to 4 cards.")
+            if not set(table) <= {c for p in played for c in p}:
+                raise ValueError("The table holds cards that were not "
+                                 "played.")
+            if player is None:
+                if phase == 1 and any(played):
+                    raise ValueError("The player to act is needed once "
+                                     "cards were played.")
+                player = (dealer + 1) % n_players
+
+        # Take the known cards out of the deck, then deal the unknown ones.
+        known = [c for h in hands if h is not None for c in h]
+        known += crib + [c for p in played for c in p]
+        if starter is not None:
+            known.append(starter)
+        if len(set(known)) != len(known):
+            raise ValueError("The same card is used twice in the position.")
+
+        deck = Deck(rng=env.rng)
+        for c in known:
+            deck.remove_(c)
+        hands = [h if h is not None else
+                 [deck.deal() for _ in range(n_cards[i])]
+                 for i, h in enumerate(hands)]
+        if phase == 2:
+            for i, h in enumerate(hands):
+                played[i] += h
+                hands[i] = []
+        if phase > 0:
+            crib += [deck.deal() for _ in range(env._crib_size - len(crib))]
+            if starter is None:
+                starter = deck.deal()
+
+        if phase == 0 and starter is not None:
+            # The starter is drawn once the crib is complete.
+            deck.set_cards([starter] + deck.cards)
+            starter = None
+
+        env.deck = deck
+        env.hands = [Stack(h) for h in hands]
+        env._update_held()
+        env.played = [Stack(p) for p in played]
+        env.crib = Stack(crib)
+        env.starter = [starter] if starter is not None else Stack()
+        env.table = Stack(table)
+        env.discarded = Stack([c for p in played for c in p
+                               if c not in table])
+        env.pegging = PeggingState()
+        for c in table:
+            env.pegging.play(c)
+        env.table_value = env.pegging.count
+
+        env.scores = np.zeros(n_players, dtype=np.uint8)
+        if scores is not None:
+            env.scores[:] = scores
+        env.dealer = dealer
+        env.player = player
+        env.last_player = dealer if phase == 0 else \
+            (player - 1) % n_players
+        env.phase = phase
+        env.prev_phase = phase
+        env.new_hand = False
+        env.initialized = True
+
+        env._reward_id = env.last_player if phase else dealer
+        env._state = None
+
+        return env
+
+    def reset(self, dealer=None, seed=None):
+        """
+        Resets the hand, additionally clearing the scoreboard. Optionally
+        reseeds the environment first.
+        """
+        if self.recorder is not None and seed is None:
+            seed = self.recorder.new_seed()
+        if seed is not None:
+            self.seed(seed)
+
+        if self.trace is not None:
+            self.trace.emit(NewGame())
 
         # Reset the persistant scores of all players.
         self.scores = np.zeros(self.n_players, dtype=np.uint8)
@@ -311,9 +734,13 @@ class CribbageEnv(gym.Env):
         # Pick dealer, clear table, shuffle, deal cards.
         reward, done, _ = self._reset_hand(dealer=dealer)
 
+        if self.recorder is not None:
+            self.recorder.start_game(seed, self.dealer, dealer is not None,
+                                     self.n_players)
+
         self.initialized = True
 
-        return(self.state, reward, done, "Reset Game!")
+        return(self._observe(), reward, done, "Reset Game!")
 
     def step(self, card):
         """
@@ -323,15 +750,17 @@ class CribbageEnv(gym.Env):
 
         Params
         ======
-            card: Card
-                A card object
+            card: Card or int
+                A card object, or its index (see Card.idx). Ignored during
+                The Show.
 
         Returns
         =======
-            (current play, past plays), points, total: (Stack, Stack), int, int
-            points is the reward for the last card played
-            total is the cummulative value of the card played in the current
-            play.
+            state, points, done, debug: State (or array), int, bool, str
+            state is the State of the next player to act, or its array
+            observation when array_obs is set.
+            points is the reward for the last card played, which goes to
+            state.reward_id.
         """
         if not self.initialized:
             raise Exception("Need to CribbageEnv.reset() before first step.")
@@ -340,169 +769,24 @@ class CribbageEnv(gym.Env):
         self.new_hand = False
         debug = "step!"
 
+        if self.phase < 2 and not isinstance(card, Card):
+            card = CARDS[card]
+
         # The Deal.
         if self.phase == 0:
-            self.logger.debug(
-                "Player {} discards {} to the crib".format(self.player, card)
-            )
-            if self.verbose:
-                print("GAME\tPlayer {} discards to the crib".format(self.player))
-            # Move card from hand to crib.
-            self.hands[self.player].discard(card)
-            self.crib.add_(card)
-
-            # Keep track of number of cards in play.
-            counts, playable_hands = self._count_playable_cards()
-            reward = 0
-            self.last_player = copy(self.player)
-
-            # The crib is complete.
-            if sum(counts) / float(self.n_players) == 4:
-                self.phase = 1
-                self.starter = [self.deck.deal()]
-                self.logger.debug("Starter drawn={}".format(self.starter))
-                if self.verbose:
-                    print("GAME\tStarter drawn={}".format(self.starter))
-
-                if self.starter[0].rank == "J":
-                    reward = 2
-                    self.logger.debug("Two for his (the dealer's) heels!")
-                    if self.verbose:
-                        print("SCORE\tTwo for player {} (the dealer's) heels!".format(self.dealer))
-
-                # Start next phase from the left of the dealer.
-                self.player = self.next_player(self.player, from_dealer=True)
-                self.logger.debug("Crib: {}".format(self.crib))
-                if self.verbose:
-                    print("GAME\tMove to the Play")
-
-            else:
-                self.player = self.next_player(self.player)
-
-            # Keep track of the player's total score.
-            self.scores[self.dealer] += reward
-
-            # Reward always goes to the dealer during the deal.
-            player_score, opponent_scores = self._get_scores()
-            self.state = State(
-                Stack(playable_hands[self.player]),
-                self.player,
-                self.dealer,
-                self.phase,
-                player_score,
-                opponent_scores
-            )
+            reward = self._step_deal(card)
 
         # The Play.
         elif self.phase == 1:
-            self.logger.debug(
-                "Player {} plays {}".format(self.player, card)
-            )
-            # Move card from player's hand to table. Keep track of player's
-            # played cards in "played", which we need for The Show.
-            self.hands[self.player].discard(card)
-            self.played[self.player].add_(card)
-            self.table.add_(card)
-            reward = self._evaluate_play()
-            self._update_table_value()
-            if self.verbose:
-                print("GAME\tPlayer {} plays {} for {}".format(self.player, card, self.table_value))
-            if self.verbose and reward > 0:
-                print('SCORE\tPlayer {} earned {} points'.format(self.player, reward))
-
-            # Check to see who can play next.
-            counts, playable_hands = self._count_playable_cards()
-
-            # self.last_player recieves the reward.
-            self.last_player = copy(self.player)
-
-            # Go! If no one else can play, give this player an extra 2 points.
-            if sum(counts) == 0:
-
-                # Reward player for placing the last card.
-                if self.table_value == MAX_TABLE_VALUE:
-                    reward += 2
-                    self.logger.debug("reward+2 for MAX_TABLE_VALUE.")
-                    if self.verbose:
-                        print("SCORE\tPlayer {} earned 2 points for {}".format(self.last_player, MAX_TABLE_VALUE))
-                else:
-                    reward += 1
-                    self.logger.debug("reward+1 for last player.")
-                    if self.verbose:
-                        print("SCORE\tPlayer {} earns 1 point for go".format(self.last_player))
-
-                remaining_cards = self._count_remaining_cards()
-
-                # Move onto The Show.
-                if remaining_cards == 0:
-                    self.logger.debug("No cards left, time for The Show.")
-                    if self.verbose:
-                        print("GAME\tMove to the Show")
-                    self.phase = 2
-                    self.player = self.next_player(self.player,
-                                                   from_dealer=True)
-
-                # Reset the table and playable cards.
-                else:
-                    self.logger.debug(
-                        "Resetting table! table_value={} n_cards={}".format(
-                            self.table_value, remaining_cards)
-                    )
-                    if self.verbose:
-                        print("GAME\tReset table")
-                    self._reset_table()
-                    self.player = self.next_player(self.player)
-                    counts, playable_hands = self._count_playable_cards()
-                    self._next_avail_player(counts, playable_hands)
-
-            # Go! Skip to the next player who has a playable hand.
-            else:
-                self.player = self.next_player(self.player)
-                self._next_avail_player(counts, playable_hands)
-
-            # Keep track of the player's total score.
-            self.scores[self.last_player] += reward
-
-            # When self.phase == 2, playable_hands[self.player] will be empty.
-            player_score, opponent_scores = self._get_scores()
-            self.state = State(
-                Stack(playable_hands[self.player]),
-                self.player,
-                self.last_player,
-                self.phase,
-                player_score,
-                opponent_scores
-            )
-
-            self.prev_phase = 1
+            reward = self._step_play(card)
 
         # The Show.
         elif self.phase == 2:
+            reward = self._step_show()
 
-            # Calculate points for self.player.
-            reward = self._evaluate_show()
-
-            # Went around the circle once. This hand is over.
-            if self.player == self.dealer:
-                self.new_hand = True
-
-            self.last_player = copy(self.player)
-            self.player = self.next_player(self.player)
-
-            # Keep track of the player's total score.
-            self.scores[self.last_player] += reward
-
-            player_score, opponent_scores = self._get_scores()
-            self.state = State(
-                Stack([]),
-                self.player,
-                self.last_player,
-                self.phase,
-                player_score,
-                opponent_scores
-            )
-
-            self.prev_phase = 2
+        # The State is rebuilt when read. With array_obs=True, step() does
+        # not read it, so it is only built if someone asks for it.
+        self._state = None
 
         # If any player, at any time, gets a winning amount of points.
         if any(self.scores >= MAX_ROUND_VALUE):
@@ -517,9 +801,139 @@ class CribbageEnv(gym.Env):
 
             # The next hand is dealt by the person next to the dealer.
             next_dealer = self.next_player(self.dealer)
-            self._reset_hand(dealer=next_dealer, reward_id=self.state.reward_id)
+            self._reset_hand(dealer=next_dealer, reward_id=self._reward_id)
+
+        if self.recorder is not None:
+            self.recorder.step(card.idx if isinstance(card, Card) else -1,
+                               reward, self._reward_id, done)
+
+        return(self._observe(), reward, done, debug)
+
+    def _step_deal(self, card):
+        """Discards card to the crib."""
+        if self.trace is not None:
+            self.trace.emit(Discard(self.player, card))
+        # Move card from hand to crib.
+        self.hands[self.player].discard(card)
+        self._held[self.player] &= ~(1 << card.idx)
+        self.crib.add_(card)
+
+        reward = 0
+        self.last_player = copy(self.player)
+
+        # The crib is complete.
+        if len(self.crib) == self._crib_size:
+            self.phase = 1
+            self.starter = [self.deck.deal()]
+
+            # Two for his (the dealer's) heels.
+            if self.starter[0].rank == "J":
+                reward = 2
+
+            if self.trace is not None:
+                self.trace.emit(Starter(self.starter[0], self.dealer,
+                                        reward, tuple(self.crib.cards)))
+
+            # Start next phase from the left of the dealer.
+            self.player = self.next_player(self.player, from_dealer=True)
+
+        else:
+            self.player = self.next_player(self.player)
+
+        # Keep track of the player's total score.
+        self.scores[self.dealer] += reward
+
+        # Reward always goes to the dealer during the deal.
+        self._reward_id = self.dealer
+
+        return reward
+
+    def _step_play(self, card):
+        """Plays card to the table."""
+        # Move card from player's hand to table. Keep track of player's
+        # played cards in "played", which we need for The Show.
+        self.hands[self.player].discard(card)
+        self._held[self.player] &= ~(1 << card.idx)
+        self.played[self.player].add_(card)
+        self.table.add_(card)
+        reward = self._evaluate_play(card)
+        self.table_value = self.pegging.count
+        if self.trace is not None:
+            self.trace.emit(
+                Play(self.player, card, self.table_value, reward))
+
+        # Check to see who can play next.
+        counts = self._count_playable_cards()
+
+        # self.last_player recieves the reward.
+        self.last_player = copy(self.player)
+
+        # Go! If no one else can play, give this player an extra 2 points.
+        if sum(counts) == 0:
+
+            # Reward player for placing the last card.
+            go = 2 if self.table_value == MAX_TABLE_VALUE else 1
+            reward += go
+            if self.trace is not None:
+                self.trace.emit(
+                    Go(self.last_player, self.table_value, go))
+
+            remaining_cards = self._count_remaining_cards()
+
+            # Move onto The Show.
+            if remaining_cards == 0:
+                if self.trace is not None:
+                    self.trace.emit(StartShow())
+                self.phase = 2
+                self.player = self.next_player(self.player,
+                                               from_dealer=True)
+
+            # Reset the table and playable cards.
+            else:
+                if self.trace is not None:
+                    self.trace.emit(
+                        ResetTable(self.table_value, remaining_cards))
+                self._reset_table()
+                self.player = self.next_player(self.player)
+                self._next_avail_player(self._count_playable_cards())
+
+        # Go! Skip to the next player who has a playable hand.
+        else:
+            self.player = self.next_player(self.player)
+            self._next_avail_player(counts)
+
+        # Keep track of the player's total score.
+        self.scores[self.last_player] += reward
+
+        self._reward_id = self.last_player
+
+        self.prev_phase = 1
+
+        return reward
+
+    def _step_show(self):
+        """Scores the hand of the current player."""
+        # Calculate points for self.player.
+        reward = self._evaluate_show()
+
+        # Went around the circle once. This hand is over.
+        if self.player == self.dealer:
+            self.new_hand = True
+
+        self.last_player = copy(self.player)
+        self.player = self.next_player(self.player)
 
-        return(self.state, reward, done, debug)
+        # Keep track of the player's total score.
+        self.scores[self.last_player] += reward
+
+        self._reward_id = self.last_player
+
+        self.prev_phase = 2
+
+        return reward
+
+    def _observe(self):
+        return self.observation() if self.array_obs else self.state
 
     def next_player(self, player, from_dealer=False):
         """
@@ -533,7 +947,6 @@ class CribbageEnv(gym.Env):
         if player > self.n_players - 1:
             player = 0
 
-        self.logger.debug("Player={}".format(self.player))
         return player
 
     def render(self, mode='human'):
@@ -564,10 +977,144 @@ class CribbageEnv(gym.Env):
     def close(self):
         pass
 
+    def enable_trace(self, maxlen=10000, echo=None):
+        """
+        Starts recording the game events (see gym_cribbage.envs.trace) in a
+        ring buffer keeping the last maxlen ones. echo, if given, is called
+        with each event. Returns the Trace, also available as env.trace.
+        """
+        self.trace = Trace(maxlen=maxlen, echo=echo)
+        return self.trace
+
+    def disable_trace(self):
+        self.trace = None
+
+    def record(self, writer):
+        """
+        Writes the games that follow with writer, a
+        gym_cribbage.records.GameWriter, or stops recording if None. Each
+        game is then seeded, from the writer when reset() is given no seed,
+        so that it can be replayed.
+        """
+        if self.recorder is not None and writer is not self.recorder:
+            self.recorder.end_game(finished=False)
+        self.recorder = writer
+
+    def enable_timings(self, dump_every=None, dump=print):
+        """
+        Starts collecting the wall time and number of calls of the methods in
+        TIMED: step(), its Deal, Play and Show branches and what they call.
+        _evaluate_play scores the table, _evaluate_show the hands (with
+        evaluate_cards) and _new_deck builds the Deck. Games are counted as
+        calls of reset(). If dump_every is given, dump(timings) is called
+        every dump_every games. Returns the Timings, also available as
+        env.timings (see Timings.as_dict()).
+        """
+        self.disable_timings()
+        timings = self.timings = Timings()
+        for name in TIMED:
+            setattr(self, name, timings.wrap(name, getattr(self, name)))
+
+        after = None
+        if dump_every:
+            def after():
+                if timings.calls["reset"] % dump_every == 0:
+                    dump(timings)
+        self.reset = timings.wrap("reset", self.reset, after)
+        return timings
+
+    def disable_timings(self):
+        """Removes the timers set by enable_timings()."""
+        for name in TIMED + ("reset",):
+            self.__dict__.pop(name, None)
+        self.timings = None
+
+    def _echo(self, event):
+        """Prints (verbose) and logs (debug) the traced events."""
+        if self.verbose:
+            print(event)
+        self.logger.debug(event)
+
+    def snapshot(self):
+        """
+        Saves the state of the game, to come back to it with restore().
+        Much cheaper than copy.deepcopy(env) for search and lookahead.
+        """
+        snap = Snapshot()
+        snap.hands = tuple(tuple(h.cards) for h in self.hands)
+        snap.held = tuple(self._held)
+        snap.played = tuple(tuple(h.cards) for h in self.played)
+        snap.table = tuple(self.table.cards)
+        snap.crib = tuple(self.crib.cards)
+        snap.starter = tuple(self.starter)
+        snap.discarded = tuple(self.discarded.cards)
+        snap.deck = self.deck.copy()
+        snap.scores = self.scores.copy()
+        snap.dealer = self.dealer
+        snap.player = self.player
+        snap.last_player = self.last_player
+        snap.table_value = self.table_value
+        snap.pegging = self.pegging.copy()
+        snap.phase = self.phase
+        snap.prev_phase = self.prev_phase
+        snap.new_hand = self.new_hand
+        snap.initialized = self.initialized
+        snap.reward_id = self._reward_id
+        return snap
+
+    def restore(self, snap):
+        """Puts the game back in the state saved by snapshot()."""
+        self.hands = [Stack(list(h)) for h in snap.hands]
+        self._held = list(snap.held)
+        self.played = [Stack(list(h)) for h in snap.played]
+        self.table = Stack(list(snap.table))
+        self.crib = Stack(list(snap.crib))
+        self.starter = list(snap.starter)
+        self.discarded = Stack(list(snap.discarded))
+        self.deck = snap.deck.copy()
+        self.scores = snap.scores.copy()
+        self.dealer = snap.dealer
+        self.player = snap.player
+        self.last_player = snap.last_player
+        self.table_value = snap.table_value
+        self.pegging = snap.pegging.copy()
+        self.phase = snap.phase
+        self.prev_phase = snap.prev_phase
+        self.new_hand = snap.new_hand
+        self.initialized = snap.initialized
+        self._reward_id = snap.reward_id
+        self._state = None
+
+    def clone(self):
+        """
+        A new environment in the same state as this one. The logger is
+        shared, everything else is independent. The clone gets its own random
+        stream, spawned from this environment's, for the hands that follow,
+        and is neither traced, recorded nor timed.
+        """
+        env = CribbageEnv.__new__(CribbageEnv)
+        env.n_players = self.n_players
+        env.verbose = self.verbose
+        env._cards_per_hand = self._cards_per_hand
+        env._crib_size = self._crib_size
+        env.logger = self.logger
+        env.trace = None
+        env.recorder = None
+        env.timings = None
+        env.array_obs = self.array_obs
+        env.observation_space = self.observation_space
+        env.action_space = self.action_space
+        env._obs = np.zeros_like(self._obs)
+        env._opponents = self._opponents
+        env._seats = self._seats
+        env.rng = self.rng.spawn(1)[0]
+        env.restore(self.snapshot())
+        env.deck.rng = env.rng
+        return env
+
     def _get_scores(self):
         player_score = self.scores[self.player]
-        opponent_scores = self.scores[np.setdiff1d(range(self.n_players),
-                                                         self.player)]
+        opponent_scores = self.scores[self._opponents[self.player]]
 
         return(player_score, opponent_scores)
 
@@ -590,37 +1137,25 @@ class CribbageEnv(gym.Env):
 
         return(item_dict)
 
-    def _update_table_value(self):
+    def _playable(self, player):
         """
-        Calculates the value of all cards played on the table.
+        Mask (see _held) of the cards of player that can be legally played,
+        i.e., adding them to the table would not make the table go over 31.
         """
-        self.table_value = np.array([c.value for c in self.table]).sum()
+        return self._held[player] & PLAYABLE_BITS[
+            MAX_TABLE_VALUE - self.table_value]
 
     def _count_playable_cards(self):
         """
         Counts the number of cards in each player's hand that can be
-        legally played, i.e., adding them to the table would not make
-        the table go over 31.
+        legally played.
         """
-        counts, playable_hands = [], []
-
-        for hand in self.hands:
-            count = 0
-            playable_hand = []
-
-            for card in hand:
-                if self.table_value + card.value <= MAX_TABLE_VALUE:
-                    count += 1
-                    playable_hand.append(card)
+        playable = PLAYABLE_BITS[MAX_TABLE_VALUE - self.table_value]
+        return [bin(held & playable).count("1") for held in self._held]
 
-            counts.append(count)
-            playable_hands.append(playable_hand)
-
-        self.logger.debug("Table={}, playable cards={}".format(
-            self.table_value, playable_hands)
-        )
-
-        return(counts, playable_hands)
+    def _update_held(self):
+        """Rebuilds the card masks of the hands, see _held."""
+        self._held = [sum(1 << c.idx for c in hand) for hand in self.hands]
 
     def _count_remaining_cards(self):
         """Counts the sum of the cards in all hands."""
@@ -629,25 +1164,22 @@ class CribbageEnv(gym.Env):
         for hand in self.hands:
             remaining_cards += len(hand)
 
-        self.logger.debug('Total remaining cards={}'.format(remaining_cards))
-
         return(remaining_cards)
 
-    def _next_avail_player(self, counts, playable_hands):
+    def _next_avail_player(self, counts):
         """
         Finds the next available player if has any
         """
         if sum(counts) != 0:
             while counts[self.player] == 0:
-                self.logger.debug("Go! Skip player {}, hand={}/{}".format(
-                    self.player,
-                    playable_hands[self.player],
-                    self.hands[self.player])
-                )
-                if self.verbose:
-                    print("GAME\tGo! Skip player {}".format(self.player))
+                if self.trace is not None:
+                    self.trace.emit(Skip(
+                        self.player, tuple(self.hands[self.player].cards)))
                 self.player = self.next_player(self.player)
 
+    def _new_deck(self):
+        return Deck(rng=self.rng)
+
     def _reset_table(self):
         """
         This method moves all cards on the table to a discard pile and
@@ -659,6 +1191,7 @@ class CribbageEnv(gym.Env):
 
         self.table_value = 0
         self.table = Stack()
+        self.pegging.reset()
 
     def _reset_hand(self, dealer=None, reward_id=None):
         """
@@ -666,13 +1199,7 @@ class CribbageEnv(gym.Env):
         cards to each of the n_player's hands, and randomly selects the
         dealer. Each user receives the appropriate number of cards.
         """
-        self.logger.debug("New hand!")
-        if self.verbose:
-            print("SCORE\tScore after the Show: Player 0 = {} vs. Player 1 = {}".format(
-                self.scores[0], self.scores[1]))
-            print("GAME\tNew hand")
-
-        self.deck = Deck()
+        self.deck = self._new_deck()
 
         # Stores the playable cards in each player's hand.
         self.hands = [Stack() for i in range(self.n_players)]
@@ -689,16 +1216,15 @@ class CribbageEnv(gym.Env):
         self.discarded = Stack()
 
         # Randomly select the dealer. Initalize the player to be the same.
-        self.dealer = random.randint(0, self.n_players - 1) if dealer is None \
-                                                            else dealer
+        if dealer is None:
+            dealer = int(self.rng.integers(self.n_players))
+        self.dealer = dealer
 
-        self.logger.debug("Player {} has the crib".format(self.dealer))
-        if self.verbose:
-            print("GAME\tPlayer {} has the crib".format(self.dealer))
         self.player = copy(self.dealer)
         self.last_player = copy(self.dealer)
 
         self.table_value = 0
+        self.pegging = PeggingState()
         self.phase = 0  # 0: the deal, 1: the play, 2: the show.
         self.prev_phase = 0  # To catch phase transitions
 
@@ -706,34 +1232,31 @@ class CribbageEnv(gym.Env):
         for i in range(self.n_players):
             for j in range(self._cards_per_hand):
                 self.hands[i].add_(self.deck.deal(player=i))
-            self.logger.debug("Player {}'s hand: {}".format(i, self.hands[i]))
-
-        # Return the hand of the dealer.
-        player_score, opponent_scores = self._get_scores()
-        self.state = State(
-            self.hands[self.player],
-            self.player,
-            reward_id,
-            self.phase,
-            player_score,
-            opponent_scores
-        )
+
+        # The same hands as bit masks over the card indices, kept up to date
+        # by step() so that finding the playable cards is a single AND.
+        self._update_held()
+
+        if self.trace is not None:
+            self.trace.emit(NewHand(
+                self.dealer, tuple(self.scores.tolist()),
+                tuple(tuple(hand.cards) for hand in self.hands)))
+
+        # The state is the hand of the dealer.
+        self._reward_id = reward_id
+        self._state = None
 
         reward = 0
         done = False
 
         return(reward, done, "Reset Hand!")
 
-    def _evaluate_play(self):
+    def _evaluate_play(self, card):
         """
         Evaluates points for the last-played card during The Play.
         These calculations do not include the starter.
         """
-        points = evaluate_table(self.table)
-
-        self.logger.debug('PLAY: player {} earned {} points'.format(
-            self.player, points)
-        )
+        points = self.pegging.play(card)
 
         return(points)
 
@@ -748,13 +1271,10 @@ class CribbageEnv(gym.Env):
             starter=self.starter[0]
         )
 
-        self.logger.debug('SHOW: player {} earned {} points'.format(
-            self.player, points)
-        )
-        if self.verbose:
-            print('SCORE\tPlayer {} earned {} points with hand {} and starter {}'.format(self.player, points,
-                                                                                         self.played[self.player],
-                                                                                         self.starter))
+        if self.trace is not None:
+            self.trace.emit(Show(self.player, points,
+                                 tuple(self.played[self.player].cards),
+                                 self.starter[0], False))
 
         if self.player == self.dealer:
             crib_points = evaluate_cards(
@@ -762,14 +1282,11 @@ class CribbageEnv(gym.Env):
                 starter=self.starter[0],
                 is_crib=True
             )
-            if self.verbose:
-                print('SCORE\tPlayer {} earned {} points with crib {} and starter {}'.format(self.player, crib_points,
-                                                                                             self.crib,
-                                                                                             self.starter))
+            if self.trace is not None:
+                self.trace.emit(Show(self.player, crib_points,
+                                     tuple(self.crib.cards),
+                                     self.starter[0], True))
             points += crib_points
-            self.logger.debug('SHOW CRIB: player {} earned {} points'.format(
-                self.player, points)
-            )
         return(points)
 
 
@@ -803,10 +1320,377 @@ def evaluate_table(cards):
     return points
 
 
+# Show points from fifteens, pairs and runs only depend on the ranks of the
+# five cards. They are indexed by a rank histogram key, where each rank adds
+# 5 ** (rank_value - 1), so the key does not depend on the order of the cards.
+RANK_KEYS = {r: 5 ** (i - 1) for r, i in RANK_TO_IDX.items()}
+_SHOW_TABLE = {}
+_SHOW_ARRAY = None
+
+
+def _build_show_table():
+    """
+    Fills _SHOW_TABLE with the fifteens, pairs and runs points of every
+    multiset of 5 ranks (at most 4 cards per rank).
+    """
+    for ranks in combinations_with_replacement(range(1, 14), 5):
+        if any(ranks.count(r) > len(SUITS) for r in ranks):
+            continue
+        _SHOW_TABLE[sum(5 ** (r - 1) for r in ranks)] = rank_points(ranks)
+
+
 def evaluate_cards(cards, starter=None, is_crib=False):
     """
     This is to evaluate the number of points in a hand. Optionally with the
-    knob
+    knob. A regular show (4 cards and a starter) is answered from a lookup
+    table, other hands are scored from their rank histogram.
+    """
+    points = 0
+
+    # If only one card on the table.
+    if len(cards) == 1:
+        return(points)
+
+    if starter is None or len(cards) != 4:
+        ranks = [c.rank_value for c in cards]
+        if starter is not None:
+            ranks.append(starter.rank_value)
+        points += rank_points(ranks)
+        points += same_suit_points(cards, starter, is_crib)
+        points += nobs_points(cards, starter)
+        return(points)
+
+    if not _SHOW_TABLE:
+        _build_show_table()
+
+    c0, c1, c2, c3 = cards
+    points = _SHOW_TABLE[RANK_KEYS[c0.rank] + RANK_KEYS[c1.rank] +
+                         RANK_KEYS[c2.rank] + RANK_KEYS[c3.rank] +
+                         RANK_KEYS[starter.rank]]
+
+    # Flush: 4 in hand (+1 with the starter), the crib needs all 5.
+    suit = c0.suit
+    if suit == c1.suit == c2.suit == c3.suit:
+        if suit == starter.suit:
+            points += 5
+        elif not is_crib:
+            points += 4
+
+    points += nobs_points(cards, starter)
+
+    return(points)
+
+
+def rank_points(ranks):
+    """
+    Points from fifteens, pairs and runs for a list of rank values (1-13),
+    computed from the rank histogram in time linear in the number of cards.
+    """
+    counts = [0] * 15
+    # ways[s] is the number of subsets of cards whose values sum to s.
+    ways = [1] + [0] * 15
+    for r in ranks:
+        counts[r] += 1
+        v = min(r, 10)
+        for s in range(15, v - 1, -1):
+            ways[s] += ways[s - v]
+
+    # Two for each fifteen.
+    points = 2 * ways[15]
+
+    # Two for each pair: C(n, 2) pairs per rank.
+    for n in counts:
+        points += n * (n - 1)
+
+    # Runs: every maximal block of consecutive ranks of length >= 3 scores
+    # its length once per choice of one card of each rank.
+    length, mult = 0, 1
+    for n in counts[1:]:
+        if n:
+            length += 1
+            mult *= n
+        else:
+            if length >= 3:
+                points += length * mult
+            length, mult = 0, 1
+
+    return(points)
+
+
+def _show_array():
+    """
+    Dense version of _SHOW_TABLE for evaluate_cards_batch(), indexed by the
+    sorted rank indices (0-12) of the five cards read as a base 13 number.
+    """
+    global _SHOW_ARRAY
+    if _SHOW_ARRAY is None:
+        if not _SHOW_TABLE:
+            _build_show_table()
+        table = np.zeros(13 ** 5, dtype=np.int8)
+        for ranks in combinations_with_replacement(range(13), 5):
+            key = sum(5 ** r for r in ranks)
+            if key in _SHOW_TABLE:
+                idx = 0
+                for r in ranks:
+                    idx = idx * 13 + r
+                table[idx] = _SHOW_TABLE[key]
+        _SHOW_ARRAY = table
+    return _SHOW_ARRAY
+
+
+def evaluate_cards_batch(hands, starters, is_crib=False):
+    """
+    Vectorized evaluate_cards() for N regular shows at once.
+
+    Cards are given by Card.idx (suit * 13 + rank), the flat index used by
+    the observations, action masks and VectorCribbageEnv, rather than the
+    (rank, suit) pairs of card_to_idx / stack_to_idx: one integer per card
+    keeps hands a plain [N, 4] array. A stack converts with
+    [c.idx for c in stack].
+
+    Params
+    ======
+        hands: ndarray[N, 4]
+            Card indices (see Card.idx) of the cards in each hand.
+        starters: ndarray[N]
+            Card index of the starter of each hand.
+        is_crib: bool or ndarray[N]
+            Whether each hand is a crib.
+
+    Returns
+    =======
+        points: ndarray[N] of int
+    """
+    hands = np.asarray(hands, dtype=np.int64)
+    starters = np.asarray(starters, dtype=np.int64)
+    is_crib = np.broadcast_to(np.asarray(is_crib, dtype=bool), starters.shape)
+
+    hand_ranks, hand_suits = hands % 13, hands // 13
+    starter_ranks, starter_suits = starters % 13, starters // 13
+
+    # Fifteens, pairs and runs.
+    ranks = np.sort(
+        np.concatenate([hand_ranks, starter_ranks[:, None]], axis=1), axis=1)
+    idx = np.zeros(len(ranks), dtype=np.int64)
+    for i in range(5):
+        idx = idx * 13 + ranks[:, i]
+    points = _show_array()[idx].astype(np.int64)
+
+    # Flush: 4 in hand (+1 with the starter), the crib needs all 5.
+    hand_flush = (hand_suits == hand_suits[:, :1]).all(axis=1)
+    starter_flush = hand_flush & (hand_suits[:, 0] == starter_suits)
+    points += np.where(starter_flush, 5, np.where(hand_flush & ~is_crib, 4, 0))
+
+    # Nobs: jack of the same suit as the starter.
+    points += ((hand_ranks == JACK) &
+               (hand_suits == starter_suits[:, None])).sum(axis=1)
+
+    return points
+
+
+def discard_values(hand):
+    """
+    Exact expected points of the 15 ways to keep 4 and throw 2 cards to the
+    crib from a 6 card hand (2 players), averaged over every possible starter
+    and, for the crib, every possible pair of cards thrown by the opponent.
+    The opponent throw is assumed to be any 2 of the unseen cards.
+
+    Params
+    ======
+        hand: list of 6 Card
+
+    Returns
+    =======
+        list of (keep, throw, hand_points, crib_points):
+            keep and throw are tuples of cards, hand_points is the expected
+            score of the kept cards and crib_points the expected score of the
+            crib, which goes to the dealer.
+    """
+    if len(hand) != 6:
+        raise ValueError("Discard values need a 6 card hand.")
+    values = _discard_values(tuple(sorted(c.idx for c in hand)))
+    return [(tuple(CARDS[i] for i in keep), tuple(CARDS[i] for i in throw),
+             hand_points, crib_points)
+            for keep, throw, hand_points, crib_points in values]
+
+
+def best_discard(hand, dealer):
+    """
+    The two cards to throw to the crib with the best expected value,
+    counting the crib for the dealer and against the other player.
+    """
+    sign = 1 if dealer else -1
+    best = max(discard_values(hand), key=lambda v: v[2] + sign * v[3])
+    return list(best[1])
+
+
+@lru_cache(maxsize=4096)
+def _discard_values(hand):
+    unseen = np.setdiff1d(np.arange(52), hand)
+    splits = [(keep, tuple(c for c in hand if c not in keep))
+              for keep in combinations(hand, 4)]
+
+    # Hands: score every kept hand with every starter.
+    keeps = np.array([keep for keep, _ in splits])
+    points = evaluate_cards_batch(
+        np.repeat(keeps, len(unseen), axis=0), np.tile(unseen, len(splits)))
+    hand_points = points.reshape(len(splits), -1).mean(axis=1)
+
+    # Crib ranks: number of (opponent pair, starter) draws for each
+    # combination of ranks a <= b for the pair and s for the starter.
+    unseen_ranks = np.bincount(unseen % 13, minlength=13)
+    a, b, s = np.meshgrid(*[np.arange(13)] * 3, indexing="ij")
+    pairs = np.where(a == b, unseen_ranks[a] * (unseen_ranks[a] - 1) // 2,
+                     unseen_ranks[a] * unseen_ranks[b])
+    starters = (unseen_ranks[s] - (a == s) - (b == s)).clip(0)
+    ways = np.where(a <= b, pairs * starters, 0).ravel()
+    n_draws = ways.sum()
+    a, b, s = a.ravel(), b.ravel(), s.ravel()
+
+    unseen_suits = np.bincount(unseen // 13, minlength=4)
+    unseen_jacks = unseen[unseen % 13 == JACK] // 13
+
+    values = []
+    for (keep, throw), hand_value in zip(splits, hand_points):
+        t1, t2 = throw
+        ranks = np.sort(np.stack([
+            np.full_like(a, t1 % 13), np.full_like(a, t2 % 13), a, b, s]),
+            axis=0)
+        idx = np.zeros_like(a)
+        for r in ranks:
+            idx = idx * 13 + r
+        crib_value = (_show_array()[idx] * ways).sum() / n_draws
+
+        # Flush: all 5 cards of the crib of the suit of the thrown cards.
+        if t1 // 13 == t2 // 13:
+            k = unseen_suits[t1 // 13]
+            crib_value += 5 * k * (k - 1) // 2 * (k - 2) / n_draws
+
+        # Nobs: the starter is uniform over the unseen cards, and has the
+        # suit of an opponent's jack with probability (k - 1) / 45.
+        for c in throw:
+            if c % 13 == JACK:
+                crib_value += unseen_suits[c // 13] / len(unseen)
+        for suit in unseen_jacks:
+            crib_value += 2. / len(unseen) * (
+                unseen_suits[suit] - 1) / (len(unseen) - 1)
+
+        values.append((keep, throw, float(hand_value), float(crib_value)))
+
+    return values
+
+
+def pegging_values(hands, table, table_value, player):
+    """
+    Solves the rest of The Play with all the hands known. Every player plays
+    to maximize their points minus the points of the others (i.e. minimax
+    for 2 players). Suits do not matter in The Play, so positions are
+    searched by rank and memoized.
+
+    Params
+    ======
+        hands: list of Stack (or lists of Card), the cards left in each hand
+        table: the cards on the table for the current count, in order
+        table_value: int, the current count
+        player: int, the player to act
+
+    Returns
+    =======
+        dict {card: points}: for each card the player can play, the points
+        the player makes until the end of The Play minus those of the others.
+    """
+    n_players = len(hands)
+    seats = [(player + k) % n_players for k in range(n_players)]
+    ranks = tuple(tuple(sorted(c.rank_value for c in hands[p])) for p in seats)
+    tail = _pegging_tail(
+        tuple(c.rank_value for c in reversed(list(table))))
+
+    values = {}
+    for card in hands[player]:
+        if table_value + card.value <= MAX_TABLE_VALUE:
+            points = _pegging_move(ranks, table_value, tail, card.rank_value)
+            values[card] = points[0] - sum(points[1:])
+    return values
+
+
+def _pegging_move(ranks, count, tail, rank):
+    """
+    Points of every player (the first one playing rank) until the end of The
+    Play. ranks are the sorted rank values of the hands, and tail the rank
+    values of the last cards on the table (most recent first), starting from
+    the player to act.
+    """
+    hand = list(ranks[0])
+    hand.remove(rank)
+    ranks = (tuple(hand),) + ranks[1:]
+    count += min(rank, 10)
+    tail = ((rank,) + tail)[:PeggingState.MAX_RUN]
+
+    points = 2 if count == 15 else 0
+    streak = 1
+    while streak < len(tail) and tail[streak] == rank:
+        streak += 1
+    points += PeggingState.PAIR_POINTS[streak]
+    points += _run_length(tail)
+
+    # Who can play next: the following players, then this one again.
+    n_players = len(ranks)
+    limit = MAX_TABLE_VALUE - count
+    nxt = next((k for k in range(1, n_players + 1)
+                if ranks[k % n_players] and
+                min(ranks[k % n_players][0], 10) <= limit), None)
+
+    if nxt is None:
+        # Go, or 31: the last player scores and the table is reset.
+        points += 2 if count == MAX_TABLE_VALUE else 1
+        nxt = next((k for k in range(1, n_players + 1)
+                    if ranks[k % n_players]), None)
+        count, tail = 0, ()
+
+    result = [points] + [0] * (n_players - 1)
+    if nxt is not None:
+        k = nxt % n_players
+        rest = _pegging_solve(ranks[k:] + ranks[:k], count,
+                              _pegging_tail(tail))
+        for i, p in enumerate(rest):
+            result[(i + k) % n_players] += p
+    return result
+
+
+def _pegging_tail(tail):
+    """
+    The part of the table (rank values, most recent first) that can still
+    score: the cards of the same rank at the end, for pairs, and the cards
+    before the first repeated rank, for runs.
+    """
+    streak = 1
+    while streak < len(tail) and tail[streak] == tail[0]:
+        streak += 1
+    for j in range(1, min(len(tail), PeggingState.MAX_RUN)):
+        if tail[j] in tail[:j]:
+            return tail[:max(j, streak)]
+    return tail[:PeggingState.MAX_RUN]
+
+
+@lru_cache(maxsize=1 << 20)
+def _pegging_solve(ranks, count, tail):
+    """Points of every player for the best play of the player to act."""
+    best, best_value = None, None
+    for rank in sorted(set(ranks[0])):
+        if count + min(rank, 10) > MAX_TABLE_VALUE:
+            continue
+        points = _pegging_move(ranks, count, tail, rank)
+        value = points[0] - sum(points[1:])
+        if best is None or value > best_value:
+            best, best_value = points, value
+    return tuple(best)
+
+
+def evaluate_cards_reference(cards, starter=None, is_crib=False):
+    """
+    This is to evaluate the number of points in a hand. Optionally with the
+    knob. Enumerates every combination of cards, kept as the reference
+    implementation for evaluate_cards().
     """
 
     points = 0
@@ -901,6 +1785,21 @@ def same_suit_points(hand, knob, is_crib=False):
     return points
 
 
+def nobs_points(hand, starter):
+    # One point for the jack in hand of the same suit as the starter.
+    if starter is None:
+        return 0
+    return sum(1 for c in hand if c.rank == "J" and c.suit == starter.suit)
+
+
+def spawn_seeds(seed, n):
+    """
+    n independent seeds derived from seed, e.g. one per worker process, to
+    be passed to CribbageEnv.seed() or numpy.random.default_rng().
+    """
+    return np.random.SeedSequence(seed).spawn(n)
+
+
 def card_to_idx(card):
     return (RANK_TO_IDX[card.rank], SUIT_TO_IDX[card.suit])
 
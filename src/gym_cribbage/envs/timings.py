@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from time import perf_counter
+
+
+class Timings(object):
+    """
+    Cumulative wall time and number of calls of the functions wrapped with
+    wrap(), see CribbageEnv.enable_timings(). Time spent in a wrapped
+    function includes the time of the wrapped functions it calls.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.time = defaultdict(float)
+
+    def wrap(self, name, func, after=None):
+        """
+        func, timed under name. after, if given, is called with no
+        arguments after every call.
+        """
+        calls, time = self.calls, self.time
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            result = func(*args, **kwargs)
+            time[name] += perf_counter() - start
+            calls[name] += 1
+            if after is not None:
+                after()
+            return result
+
+        timed.__wrapped__ = func
+        return timed
+
+    def as_dict(self):
+        """{name: {"calls": int, "time": seconds, "mean": seconds}}"""
+        return {name: {"calls": self.calls[name],
+                       "time": self.time[name],
+                       "mean": self.time[name] / self.calls[name]}
+                for name in self.calls}
+
+    def reset(self):
+        self.calls.clear()
+        self.time.clear()
+
+    def __str__(self):
+        rows = ["{:24s} {:>12s} {:>12s} {:>12s}".format(
+            "", "calls", "time (s)", "mean (us)")]
+        for name, t in sorted(self.as_dict().items(),
+                              key=lambda item: -item[1]["time"]):
+            rows.append("{:24s} {:12d} {:12.3f} {:12.2f}".format(
+                name, t["calls"], t["time"], 1e6 * t["mean"]))
+        return "\n".join(rows)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque, namedtuple
+
+# Events of a CribbageEnv game. They are only created when the environment is
+# traced (see CribbageEnv.enable_trace), str(event) is the line printed by a
+# verbose environment. Some fields (hands, discarded cards, the crib) are only
+# kept in the events and not printed.
+
+
+class NewGame(namedtuple("NewGame", "")):
+    __slots__ = ()
+
+    def __str__(self):
+        return "GAME\tNew Game!"
+
+
+class NewHand(namedtuple("NewHand", "dealer scores hands")):
+    __slots__ = ()
+
+    def __str__(self):
+        return "\n".join(
+            ["SCORE\tScore after the Show: " + " vs. ".join(
+                "Player {} = {}".format(i, score)
+                for i, score in enumerate(self.scores)),
+             "GAME\tNew hand",
+             "GAME\tPlayer {} has the crib".format(self.dealer)])
+
+
+class Discard(namedtuple("Discard", "player card")):
+    __slots__ = ()
+
+    def __str__(self):
+        return "GAME\tPlayer {} discards to the crib".format(self.player)
+
+
+class Starter(namedtuple("Starter", "card dealer points crib")):
+    """The starter is drawn, points is 2 for his heels."""
+    __slots__ = ()
+
+    def __str__(self):
+        lines = ["GAME\tStarter drawn=[{}]".format(self.card)]
+        if self.points:
+            lines.append("SCORE\tTwo for player {} (the dealer's) "
+                         "heels!".format(self.dealer))
+        lines.append("GAME\tMove to the Play")
+        return "\n".join(lines)
+
+
+class Play(namedtuple("Play", "player card count points")):
+    __slots__ = ()
+
+    def __str__(self):
+        line = "GAME\tPlayer {} plays {} for {}".format(
+            self.player, self.card, self.count)
+        if self.points > 0:
+            line += "\nSCORE\tPlayer {} earned {} points".format(
+                self.player, self.points)
+        return line
+
+
+class Go(namedtuple("Go", "player count points")):
+    """Nobody else can play, the last player scores the go (or 31)."""
+    __slots__ = ()
+
+    def __str__(self):
+        if self.points == 2:
+            return "SCORE\tPlayer {} earned 2 points for {}".format(
+                self.player, self.count)
+        return "SCORE\tPlayer {} earns 1 point for go".format(self.player)
+
+
+class Skip(namedtuple("Skip", "player hand")):
+    """The player cannot play on this count."""
+    __slots__ = ()
+
+    def __str__(self):
+        return "GAME\tGo! Skip player {}".format(self.player)
+
+
+class ResetTable(namedtuple("ResetTable", "count remaining")):
+    __slots__ = ()
+
+    def __str__(self):
+        return "GAME\tReset table"
+
+
+class StartShow(namedtuple("StartShow", "")):
+    __slots__ = ()
+
+    def __str__(self):
+        return "GAME\tMove to the Show"
+
+
+class Show(namedtuple("Show", "player points cards starter is_crib")):
+    __slots__ = ()
+
+    def __str__(self):
+        # The cards are printed like a Stack.
+        cards = "-".join(str(c) for c in self.cards) or "empty"
+        return "SCORE\tPlayer {} earned {} points with {} {} and starter " \
+            "[{}]".format(self.player, self.points,
+                          "crib" if self.is_crib else "hand",
+                          cards, self.starter)
+
+
+class Trace(object):
+    """
+    Bounded ring buffer of the latest game events. echo, if given, is
+    called with every event as it is recorded (e.g. print).
+    """
+
+    def __init__(self, maxlen=10000, echo=None):
+        self.events = deque(maxlen=maxlen)
+        self.echo = echo
+
+    def emit(self, event):
+        self.events.append(event)
+        if self.echo is not None:
+            self.echo(event)
+
+    def clear(self):
+        self.events.clear()
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
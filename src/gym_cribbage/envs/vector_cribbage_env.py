@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import gym
+import numpy as np
+
+from gym_cribbage.envs.cribbage_env import (
+    CARDS,
+    CARD_RANK_VALUES,
+    CARD_VALUES,
+    JACK,
+    MAX_ROUND_VALUE,
+    MAX_SCORE,
+    MAX_TABLE_VALUE,
+    OBS_DEALER,
+    OBS_HAND,
+    OBS_PHASE,
+    OBS_PLAYED,
+    OBS_SCORES,
+    OBS_STARTER,
+    OBS_TABLE,
+    OBS_TABLE_VALUE,
+    Stack,
+    evaluate_cards,
+    evaluate_cards_batch,
+)
+
+VALUES = np.array(CARD_VALUES, dtype=np.int16)
+RANK_VALUES = np.array(CARD_RANK_VALUES, dtype=np.int16)
+
+MAX_TABLE_CARDS = 16  # More cards than can ever be on the table.
+MAX_RUN = 7  # A-7 is the longest run that fits under 31.
+PAIR_POINTS = np.array([0, 0, 2, 6, 12], dtype=np.int16)
+
+
+class VectorCribbageEnv(object):
+    """
+    Steps num_envs cribbage games in lockstep, with all the state held in
+    NumPy arrays. Follows the rules of CribbageEnv, except that The Show does
+    not need any action: it is scored as soon as The Play ends.
+
+    Actions are card indices (see Card.idx), one per game, for the current
+    player of each game. Rewards are given per player, so that every player
+    of every game gets its points for the step. Finished games are reset
+    automatically, the returned observation is then the first one of the
+    new game.
+    """
+
+    def __init__(self, num_envs=1, n_players=2, seed=None):
+        super(VectorCribbageEnv, self).__init__()
+
+        if n_players < 2 or n_players > 4:
+            raise ValueError("Cribbage is played by 2-4 players.")
+
+        self.num_envs = num_envs
+        self.n_players = n_players
+        self._cards_per_hand = 6 if n_players == 2 else 5
+        self._crib_size = n_players * (self._cards_per_hand - 4)
+        self.rng = np.random.default_rng(seed)
+
+        self.obs_size = OBS_SCORES + n_players
+        self.observation_space = gym.spaces.Box(
+            0, MAX_SCORE, (num_envs, self.obs_size), np.int16)
+        self.action_space = gym.spaces.MultiDiscrete([52] * num_envs)
+
+        n, p = num_envs, n_players
+        self._rows = np.arange(n)
+        self.held = np.zeros((n, p, 52), dtype=bool)
+        self.kept = np.zeros((n, p, 4), dtype=np.int64)
+        self.crib = np.zeros((n, self._crib_size), dtype=np.int64)
+        self.crib_len = np.zeros(n, dtype=np.int64)
+        self.starter = np.zeros(n, dtype=np.int64)
+        self.on_table = np.zeros((n, 52), dtype=bool)
+        self.seen = np.zeros((n, 52), dtype=bool)
+        self.table_ranks = np.zeros((n, MAX_TABLE_CARDS), dtype=np.int16)
+        self.table_len = np.zeros(n, dtype=np.int64)
+        self.table_value = np.zeros(n, dtype=np.int16)
+        self.scores = np.zeros((n, p), dtype=np.int16)
+        self.dealer = np.zeros(n, dtype=np.int64)
+        self.player = np.zeros(n, dtype=np.int64)
+        self.phase = np.zeros(n, dtype=np.int64)
+
+        self._obs = np.zeros((n, self.obs_size), dtype=np.int16)
+        self._mask = np.zeros((n, 52), dtype=bool)
+
+    def reset(self):
+        """Starts a new game in every env. Returns (observations, masks)."""
+        self._reset_game(self._rows)
+        return(self._observe(), self.legal_action_mask())
+
+    def step(self, actions):
+        """
+        Plays one card in every game.
+
+        Params
+        ======
+            actions: ndarray[num_envs] of int
+                Card index played (or discarded) by the current player of
+                each game. Must be legal, see legal_action_mask().
+
+        Returns
+        =======
+            observations, rewards, dones, masks:
+                ndarray[num_envs, obs_size], ndarray[num_envs, n_players],
+                ndarray[num_envs] of bool, ndarray[num_envs, 52] of bool
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        if not self._mask[self._rows, actions].all():
+            raise ValueError("Illegal action in games {}".format(
+                np.flatnonzero(~self._mask[self._rows, actions])))
+
+        rewards = np.zeros((self.num_envs, self.n_players), dtype=np.int16)
+        dones = np.zeros(self.num_envs, dtype=bool)
+
+        deal = np.flatnonzero(self.phase == 0)
+        if len(deal):
+            self._step_deal(deal, actions[deal], rewards, dones)
+
+        # Games which just finished the deal (or were won by his heels) have
+        # phase 1 already.
+        play = np.flatnonzero(self.phase == 1)
+        play = play[~np.isin(play, deal)]
+        if len(play):
+            self._step_play(play, actions[play], rewards, dones)
+
+        finished = np.flatnonzero(dones)
+        if len(finished):
+            self._reset_game(finished)
+
+        return(self._observe(), rewards, dones, self.legal_action_mask())
+
+    def legal_action_mask(self):
+        """Cards the current player of each game is allowed to play."""
+        mask = self._mask
+        mask[:] = self.held[self._rows, self.player]
+        play = self.phase == 1
+        mask[play] &= VALUES[None, :] <= (
+            MAX_TABLE_VALUE - self.table_value[play, None])
+        return mask
+
+    def _step_deal(self, rows, cards, rewards, dones):
+        """Moves the cards from the hands to the crib."""
+        self.held[rows, self.player[rows], cards] = False
+        self.crib[rows, self.crib_len[rows]] = cards
+        self.crib_len[rows] += 1
+        self.player[rows] = (self.player[rows] + 1) % self.n_players
+
+        full = rows[self.crib_len[rows] == self._crib_size]
+        if len(full):
+            # Each player holds exactly 4 cards, keep them for The Show.
+            held = self.held[full]
+            self.kept[full] = np.argsort(
+                ~held, axis=-1, kind="stable")[..., :4]
+
+            # Two for his heels.
+            heels = full[self.starter[full] % 13 == JACK]
+            rewards[heels, self.dealer[heels]] += 2
+            self.scores[heels, self.dealer[heels]] += 2
+            dones[heels[self.scores[heels, self.dealer[heels]] >=
+                        MAX_ROUND_VALUE]] = True
+
+            self.phase[full] = 1
+            self.player[full] = (self.dealer[full] + 1) % self.n_players
+
+    def _step_play(self, rows, cards, rewards, dones):
+        """Plays the cards to the table and scores them."""
+        players = self.player[rows]
+        self.held[rows, players, cards] = False
+        self.on_table[rows, cards] = True
+        self.seen[rows, cards] = True
+        self.table_ranks[rows, self.table_len[rows]] = RANK_VALUES[cards]
+        self.table_len[rows] += 1
+        self.table_value[rows] += VALUES[cards]
+
+        points = self._evaluate_table(rows)
+
+        # Who can still play on this count.
+        can_play = (self.held[rows] & (VALUES[None, None, :] <= (
+            MAX_TABLE_VALUE - self.table_value[rows, None, None]))).any(-1)
+        go = ~can_play.any(-1)
+        points += go * np.where(
+            self.table_value[rows] == MAX_TABLE_VALUE, 2, 1).astype(np.int16)
+
+        rewards[rows, players] += points
+        self.scores[rows, players] += points
+        won = (self.scores[rows] >= MAX_ROUND_VALUE).any(-1)
+        dones[rows[won]] = True
+
+        # Go: clear the table, everybody with cards can play again.
+        reset = go & ~won
+        self.on_table[rows[reset]] = False
+        self.table_len[rows[reset]] = 0
+        self.table_value[rows[reset]] = 0
+        can_play[reset] = self.held[rows[reset]].any(-1)
+
+        # No cards left, time for The Show.
+        show = reset & ~can_play.any(-1)
+        self._show(rows[show], rewards, dones)
+
+        nxt = ~won & ~show
+        self.player[rows[nxt]] = self._next_avail_player(
+            players[nxt], can_play[nxt])
+
+    def _evaluate_table(self, rows):
+        """Vectorized evaluate_table() for the last card of each table."""
+        n = len(rows)
+        idx = np.arange(n)
+        length = self.table_len[rows]
+        ranks = self.table_ranks[rows]
+        last = ranks[idx, length - 1]
+
+        points = np.where(self.table_value[rows] == 15, 2, 0).astype(np.int16)
+
+        # Pairs: number of cards of the same rank at the end of the table.
+        same = np.ones(n, dtype=bool)
+        n_same = np.ones(n, dtype=np.int64)
+        for j in range(2, 5):
+            same &= (length >= j) & (ranks[idx, (length - j).clip(0)] == last)
+            n_same += same
+        points += PAIR_POINTS[n_same]
+
+        # Runs: the longest run at the end of the table.
+        run = np.zeros(n, dtype=np.int16)
+        for size in range(3, min(MAX_RUN, length.max()) + 1):
+            window = ranks[idx[:, None], (
+                length[:, None] - size + np.arange(size)).clip(0)]
+            window = np.sort(window, axis=1)
+            is_run = (length >= size) & (np.diff(window, axis=1) == 1).all(1)
+            run[is_run] = size
+        points += run
+
+        return points
+
+    def _next_avail_player(self, players, can_play):
+        """
+        Next player (possibly the same one, after going around) who can
+        play, starting from the left of players.
+        """
+        nxt = players.copy()
+        found = np.zeros(len(players), dtype=bool)
+        idx = np.arange(len(players))
+        for k in range(1, self.n_players + 1):
+            cand = (players + k) % self.n_players
+            hit = ~found & can_play[idx, cand]
+            nxt[hit] = cand[hit]
+            found |= hit
+        return nxt
+
+    def _show(self, rows, rewards, dones):
+        """
+        Scores The Show of each player, starting from the left of the dealer,
+        and deals the next hand. Stops as soon as a player wins.
+        """
+        if len(rows) == 0:
+            return
+
+        active = np.ones(len(rows), dtype=bool)
+        for k in range(1, self.n_players + 1):
+            r = rows[active]
+            players = (self.dealer[r] + k) % self.n_players
+            points = evaluate_cards_batch(
+                self.kept[r, players], self.starter[r]).astype(np.int16)
+
+            # The dealer also scores the crib.
+            if k == self.n_players:
+                points += self._evaluate_crib(r)
+
+            rewards[r, players] += points
+            self.scores[r, players] += points
+            won = self.scores[r, players] >= MAX_ROUND_VALUE
+            dones[r[won]] = True
+            active[np.flatnonzero(active)[won]] = False
+
+        r = rows[active]
+        self.dealer[r] = (self.dealer[r] + 1) % self.n_players
+        self._reset_hand(r)
+
+    def _evaluate_crib(self, rows):
+        if self._crib_size == 4:
+            return evaluate_cards_batch(
+                self.crib[rows], self.starter[rows], is_crib=True)
+
+        return np.array([evaluate_cards(
+            Stack([CARDS[c] for c in self.crib[i]]),
+            starter=CARDS[self.starter[i]],
+            is_crib=True) for i in rows], dtype=np.int16)
+
+    def _reset_game(self, rows):
+        """Clears the scores, randomly picks the dealers and deals."""
+        self.scores[rows] = 0
+        self.dealer[rows] = self.rng.integers(
+            0, self.n_players, size=len(rows))
+        self._reset_hand(rows)
+
+    def _reset_hand(self, rows):
+        """Shuffles and deals a new hand in the given games."""
+        n = len(rows)
+        n_dealt = self.n_players * self._cards_per_hand
+        decks = np.argsort(self.rng.random((n, 52)), axis=1)
+
+        hands = decks[:, :n_dealt].reshape(
+            n, self.n_players, self._cards_per_hand)
+        held = np.zeros((n, self.n_players, 52), dtype=bool)
+        np.put_along_axis(held, hands, True, axis=-1)
+        self.held[rows] = held
+        self.starter[rows] = decks[:, n_dealt]
+
+        self.crib_len[rows] = 0
+        self.on_table[rows] = False
+        self.seen[rows] = False
+        self.table_len[rows] = 0
+        self.table_value[rows] = 0
+        self.phase[rows] = 0
+        self.player[rows] = self.dealer[rows]
+
+    def _observe(self):
+        """Writes the observations of all games in a preallocated buffer."""
+        obs = self._obs
+        rows, players = self._rows, self.player
+        obs[:, OBS_HAND] = self.held[rows, players]
+        obs[:, OBS_TABLE] = self.on_table
+        obs[:, OBS_PLAYED] = self.seen & ~self.on_table
+        obs[:, OBS_STARTER] = 0
+        play = np.flatnonzero(self.phase == 1)
+        obs[play, OBS_STARTER.start + self.starter[play]] = 1
+        obs[:, OBS_PHASE] = self.phase
+        obs[:, OBS_TABLE_VALUE] = self.table_value
+        obs[:, OBS_DEALER] = players == self.dealer
+        for j in range(self.n_players):
+            obs[:, OBS_SCORES + j] = self.scores[
+                rows, (players + j) % self.n_players]
+        return obs
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from gym_cribbage.envs.cribbage_env import CARDS, CribbageEnv
+
+# A record file holds the steps of all the games, one after the other, and an
+# index (path + ".idx") with one entry per game. A game is replayed from its
+# seed, the dealer and the actions. Rewards are kept to analyse games without
+# replaying them.
+STEP_DTYPE = np.dtype([
+    ("action", "i1"),  # Card.idx, -1 for The Show.
+    ("reward", "u1"),
+    ("scorer", "u1"),  # Who got the reward, i.e. State.reward_id.
+])
+GAME_DTYPE = np.dtype([
+    ("seed", "<u8"),
+    ("offset", "<u8"),  # Index of the first step of the game.
+    ("n_steps", "<u2"),
+    ("dealer", "u1"),
+    ("n_players", "u1"),
+    ("flags", "u1"),
+])
+
+# Flags of a game.
+DEALER_GIVEN = 1  # The dealer was passed to reset(), not drawn.
+FINISHED = 2  # The game went on until someone won.
+
+GameRecord = namedtuple(
+    "GameRecord", "seed dealer n_players flags steps")
+
+
+class GameWriter(object):
+    """
+    Records the games played in a CribbageEnv, see CribbageEnv.record().
+    Games are written once they are over, or when the next game starts.
+    Games that are not seeded get a seed drawn from seed, so that every
+    game can be replayed.
+    """
+
+    def __init__(self, path, seed=None):
+        self.path = path
+        self._steps_file = open(path, "ab")
+        self._games_file = open(path + ".idx", "ab")
+        self._n_steps = os.path.getsize(path) // STEP_DTYPE.itemsize
+        self._seed_seq = np.random.SeedSequence(seed)
+        self._game = None
+        self._steps = []
+
+    def new_seed(self):
+        """A seed for a game that was not given one."""
+        return int(self._seed_seq.spawn(1)[0].generate_state(
+            1, dtype=np.uint64)[0])
+
+    def start_game(self, seed, dealer, dealer_given, n_players):
+        if not isinstance(seed, (int, np.integer)):
+            raise ValueError("Recorded games must be seeded with an int.")
+        self.end_game(finished=False)
+        self._game = (seed, dealer, n_players,
+                      DEALER_GIVEN if dealer_given else 0)
+
+    def step(self, action, reward, scorer, done):
+        # The steps of a game started before recording are not written.
+        if self._game is None:
+            return
+        self._steps.append((action, reward, scorer))
+        if done:
+            self.end_game(finished=True)
+
+    def end_game(self, finished):
+        """Writes the current game, if any."""
+        if self._game is None:
+            return
+        seed, dealer, n_players, flags = self._game
+        steps = np.array(self._steps, dtype=STEP_DTYPE)
+        game = np.array([(seed, self._n_steps, len(steps), dealer, n_players,
+                          flags | (FINISHED if finished else 0))],
+                        dtype=GAME_DTYPE)
+        self._steps_file.write(steps.tobytes())
+        self._games_file.write(game.tobytes())
+        self._n_steps += len(steps)
+        self._game = None
+        self._steps = []
+
+    def close(self):
+        """Writes the unfinished game, if any, and closes the files."""
+        self.end_game(finished=False)
+        self._steps_file.close()
+        self._games_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GameReader(object):
+    """
+    Reads the games written by a GameWriter. The files are memory-mapped,
+    games are only read when accessed, by index or by iterating.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.games = _memmap(path + ".idx", GAME_DTYPE)
+        self.steps = _memmap(path, STEP_DTYPE)
+
+    def __len__(self):
+        return len(self.games)
+
+    def __getitem__(self, i):
+        game = self.games[i]
+        start = int(game["offset"])
+        return GameRecord(int(game["seed"]), int(game["dealer"]),
+                          int(game["n_players"]), int(game["flags"]),
+                          self.steps[start:start + int(game["n_steps"])])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _memmap(path, dtype):
+    # np.memmap() cannot map an empty file.
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def replay(game, env=None):
+    """
+    Plays a GameRecord again. Yields (env, action, reward, scorer) after
+    every step, env being in the state that followed the step (snapshot() it
+    to keep it). Raises ValueError if the rewards differ from the record.
+    """
+    if env is None:
+        env = CribbageEnv(n_players=game.n_players)
+    env.reset(dealer=game.dealer if game.flags & DEALER_GIVEN else None,
+              seed=game.seed)
+    if env.dealer != game.dealer:
+        raise ValueError("The game was dealt by player {}, not {}.".format(
+            game.dealer, env.dealer))
+
+    for action, reward, scorer in game.steps.tolist():
+        _, r, _, _ = env.step(CARDS[action] if action >= 0 else None)
+        if (r, env.state.reward_id) != (reward, scorer):
+            raise ValueError("The replay does not match the record.")
+        yield env, action, reward, scorer
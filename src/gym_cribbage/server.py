@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+
+import numpy as np
+
+from gym_cribbage.envs.cribbage_env import Card, CribbageEnv, Stack
+from gym_cribbage.envs.trace import Discard, NewHand, Skip, Starter
+
+# An asyncio server hosting CribbageEnv games. Clients talk to it in JSON
+# objects, one per line, and cards are given by their index (see Card.idx).
+#
+# Client -> server:
+#   {"type": "join", "players": 2, "name": "..."}  wait for a table of 2-4
+#   {"type": "play", "card": 12}                   discard or peg a card
+# Server -> client:
+#   {"type": "start", "game": 0, "seat": 1, "n_players": 2, "names": [...]}
+#   {"type": "event", "event": "Play", ...}  the events of gym_cribbage.envs.
+#       trace, without what the seat is not allowed to see
+#   {"type": "turn", "phase": 0, "hand": [...], "legal": [...], ...}
+#   {"type": "error", "message": "..."}  the last message was rejected
+#   {"type": "end", "scores": [...], "winner": 0}  or, if a seat left or
+#       timed out, {"type": "end", "abandoned": 1}
+#
+# Every connection plays one seat at a time. Once its game ends, it can join
+# another one. Games only wait for the seat to act, and every client has its
+# own writer task, so a slow client only slows down its own game.
+
+MIN_PLAYERS = 2
+MAX_PLAYERS = 4
+
+
+class Connection(object):
+    """
+    A client. Messages are queued and written by a separate task: send()
+    never waits, and a client leaving more than max_pending messages unread
+    is disconnected.
+    """
+
+    def __init__(self, reader, writer, max_pending=256):
+        self.reader = reader
+        self.writer = writer
+        self.name = None
+        self.closed = False
+        self._outbox = asyncio.Queue(maxsize=max_pending)
+        self._sender = asyncio.ensure_future(self._send_all())
+
+    def send(self, message):
+        if self.closed:
+            return
+        try:
+            self._outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            self.abort()
+
+    async def receive(self, timeout=None):
+        """
+        The next message (a dict). Returns None once the client is gone, or
+        when it sent nothing for timeout seconds.
+        """
+        while not self.closed:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), timeout)
+            except asyncio.TimeoutError:
+                self.send({"type": "error", "message": "Timed out."})
+                return None
+            except (ValueError, ConnectionError):
+                # ValueError: the line is longer than the reader's limit.
+                return None
+            if not line:
+                return None
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                message = None
+            if isinstance(message, dict):
+                return message
+            self.send({"type": "error", "message": "Expected a JSON object."})
+        return None
+
+    async def close(self):
+        """Writes the queued messages and closes the connection."""
+        if not self.closed:
+            self.closed = True
+            try:
+                self._outbox.put_nowait(None)
+            except asyncio.QueueFull:
+                self._sender.cancel()
+        try:
+            await self._sender
+        except asyncio.CancelledError:
+            pass
+
+    def abort(self):
+        """Closes the connection right away, dropping the queued messages."""
+        self.closed = True
+        self._sender.cancel()
+
+    async def _send_all(self):
+        try:
+            closing = False
+            while not closing:
+                # Writes all the queued messages at once, None closes.
+                messages = [await self._outbox.get()]
+                while not self._outbox.empty():
+                    messages.append(self._outbox.get_nowait())
+                if None in messages:
+                    closing = True
+                    messages = messages[:messages.index(None)]
+                self.writer.write(b"".join(
+                    json.dumps(m, separators=(",", ":")).encode() + b"\n"
+                    for m in messages))
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+
+def _jsonable(value):
+    if isinstance(value, Card):
+        return value.idx
+    if isinstance(value, (Stack, list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def event_message(event, seat):
+    """The message telling seat about a trace event, hiding other hands."""
+    fields = event._asdict()
+    if isinstance(event, NewHand):
+        fields["hand"] = fields.pop("hands")[seat]
+    elif isinstance(event, Discard) and event.player != seat:
+        fields["card"] = None
+    elif isinstance(event, Starter):
+        # The crib is shown with The Show.
+        del fields["crib"]
+    elif isinstance(event, Skip) and event.player != seat:
+        del fields["hand"]
+    message = {"type": "event", "event": type(event).__name__}
+    message.update((k, _jsonable(v)) for k, v in fields.items())
+    return message
+
+
+class Game(object):
+    """A game between connections, one per seat, played with run()."""
+
+    def __init__(self, game_id, seats, seed=None, move_timeout=None):
+        self.game_id = game_id
+        self.seats = seats
+        self.seed = seed
+        self.move_timeout = move_timeout
+        self.env = CribbageEnv(n_players=len(seats))
+        self.env.enable_trace(maxlen=1, echo=self._broadcast)
+
+    async def run(self):
+        """
+        Plays the game. Returns the seats that left or timed out, the game
+        being abandoned as soon as one does.
+        """
+        env = self.env
+        names = [conn.name for conn in self.seats]
+        for seat, conn in enumerate(self.seats):
+            conn.send({"type": "start", "game": self.game_id, "seat": seat,
+                       "n_players": len(self.seats), "names": names})
+
+        _, _, done, _ = env.reset(seed=self.seed)
+        while not done:
+            if env.phase == 2:
+                card = None
+            else:
+                card = await self._move(env.player)
+                if card is None:
+                    for conn in self.seats:
+                        conn.send({"type": "end", "abandoned": env.player})
+                    return [self.seats[env.player]]
+            _, _, done, _ = env.step(card)
+
+        scores = env.scores.tolist()
+        for conn in self.seats:
+            conn.send({"type": "end", "scores": scores,
+                       "winner": int(np.argmax(env.scores))})
+        return []
+
+    async def _move(self, seat):
+        """The card played by seat, None if it left."""
+        env, conn = self.env, self.seats[seat]
+        legal = env.legal_action_mask()
+        conn.send({
+            "type": "turn",
+            "phase": env.phase,
+            "hand": _jsonable(env.hands[seat]),
+            "legal": np.flatnonzero(legal).tolist(),
+            "table": _jsonable(env.table),
+            "count": env.table_value,
+            "starter": _jsonable(env.starter[0]) if env.phase else None,
+            "dealer": env.dealer,
+            "scores": env.scores.tolist(),
+        })
+        while True:
+            message = await conn.receive(self.move_timeout)
+            if message is None:
+                return None
+            card = message.get("card")
+            if message.get("type") != "play":
+                conn.send({"type": "error",
+                           "message": "It is your turn to play."})
+            elif (not isinstance(card, int) or isinstance(card, bool) or
+                  not 0 <= card < 52 or not legal[card]):
+                conn.send({"type": "error",
+                           "message": "{!r} cannot be played.".format(card)})
+            else:
+                return card
+
+    def _broadcast(self, event):
+        for seat, conn in enumerate(self.seats):
+            conn.send(event_message(event, seat))
+
+
+class GameServer(object):
+    """
+    Seats the clients joining with the same number of players at the same
+    table, in the order they join, and runs the games concurrently. A seat
+    taking more than move_timeout seconds to play (if given) forfeits the
+    game. Games are seeded from seed.
+    """
+
+    def __init__(self, seed=None, move_timeout=None, max_pending=256):
+        self.move_timeout = move_timeout
+        self.max_pending = max_pending
+        self.games = {}
+        self._seed_seq = np.random.SeedSequence(seed)
+        self._n_games = 0
+        self._waiting = defaultdict(list)
+        self._tasks = set()
+
+    async def start(self, host=None, port=None, path=None, backlog=1024):
+        """
+        Listens on host:port, or on the Unix socket path. backlog is the
+        number of connections waiting to be accepted. Returns the asyncio
+        Server.
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(
+                self.handle, path, backlog=backlog)
+        return await asyncio.start_server(
+            self.handle, host, port, backlog=backlog)
+
+    async def handle(self, reader, writer):
+        """Serves a client, until it leaves."""
+        conn = Connection(reader, writer, self.max_pending)
+        try:
+            while True:
+                message = await conn.receive()
+                if message is None:
+                    break
+                n_players = message.get("players", MIN_PLAYERS)
+                if (message.get("type") != "join" or
+                        type(n_players) is not int or
+                        not MIN_PLAYERS <= n_players <= MAX_PLAYERS):
+                    conn.send({"type": "error", "message": "Join a game of "
+                               "{}-{} players first.".format(MIN_PLAYERS,
+                                                             MAX_PLAYERS)})
+                    continue
+                conn.name = message.get("name")
+                if not await self._join(conn, n_players):
+                    break
+        finally:
+            await conn.close()
+
+    async def _join(self, conn, n_players):
+        """
+        Waits for a table and the end of its game. Returns whether conn can
+        play again.
+        """
+        waiting = self._waiting[n_players]
+        # Drop the clients that left while waiting.
+        for c, f in list(waiting):
+            if c.closed or c.reader.at_eof():
+                waiting.remove((c, f))
+                f.set_result(False)
+        done = asyncio.get_running_loop().create_future()
+        waiting.append((conn, done))
+        if len(waiting) == n_players:
+            seats, futures = zip(*waiting)
+            waiting.clear()
+            task = asyncio.ensure_future(self._play(list(seats), futures))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        try:
+            return await done
+        finally:
+            if (conn, done) in waiting:
+                waiting.remove((conn, done))
+
+    async def close(self):
+        """
+        Stops the games being played and sends the waiting clients away.
+        """
+        for waiting in self._waiting.values():
+            for _, done in waiting:
+                done.set_result(False)
+            waiting.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _play(self, seats, futures):
+        game_id = self._n_games
+        self._n_games += 1
+        game = self.games[game_id] = Game(
+            game_id, seats, seed=self._seed_seq.spawn(1)[0],
+            move_timeout=self.move_timeout)
+        left = seats
+        try:
+            left = await game.run()
+        finally:
+            del self.games[game_id]
+            for conn, done in zip(seats, futures):
+                if not done.done():
+                    done.set_result(conn not in left)
+
+
+def serve(host=None, port=None, path=None, **kwargs):
+    """Runs a GameServer (see GameServer for kwargs) until interrupted."""
+    async def main():
+        game_server = GameServer(**kwargs)
+        server = await game_server.start(host, port, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await game_server.close()
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve cribbage games over line-delimited JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--unix", help="listen on this Unix socket instead")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--move-timeout", type=float, default=None)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.unix, seed=args.seed,
+          move_timeout=args.move_timeout)
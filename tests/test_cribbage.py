@@ -4,6 +4,8 @@
 # @Last Modified by:   Alexis Tremblay
 # @Last Modified time: 2019-03-09 14:07:20
 
+import os
+import tempfile
 import unittest
 import random
 import numpy as np
@@ -15,11 +17,37 @@ from gym_cribbage.envs.cribbage_env import (
     SUITS,
     Stack,
     evaluate_cards,
+    evaluate_cards_reference,
+    evaluate_cards_batch,
+    rank_points,
     evaluate_table,
+    Deck,
     card_to_idx,
     CribbageEnv,
-    stack_to_idx
+    stack_to_idx,
+    spawn_seeds,
+    PeggingState,
+    discard_values,
+    best_discard,
+    pegging_values,
+    CARDS,
+    MAX_TABLE_VALUE,
+    MAX_ROUND_VALUE,
+    JACK,
+    OBS_SCORES
 )
+from gym_cribbage.records import GameReader, GameWriter, replay
+from gym_cribbage.envs.trace import Go, NewGame, Play, Show, Starter
+from gym_cribbage.envs.vector_cribbage_env import VectorCribbageEnv
+
+
+def _deal_of(vec_env):
+    # A CribbageEnv at the start of the hand dealt in the first game of
+    # vec_env, with the same scores and starter.
+    return CribbageEnv.from_position(
+        [[CARDS[c] for c in np.flatnonzero(held)] for held in vec_env.held[0]],
+        dealer=int(vec_env.dealer[0]), scores=vec_env.scores[0],
+        starter=CARDS[vec_env.starter[0]], rng=0)
 
 
 class CribbageEnvTest(unittest.TestCase):
@@ -118,6 +146,96 @@ class CribbageEnvTest(unittest.TestCase):
             evaluate_cards(hand, starter=Card(RANKS[3], SUITS[0])), 5
         )
 
+    def test_evaluate_cards_table(self):
+        # The lookup table must agree with the reference evaluation.
+        random.seed(0)
+        np.random.seed(0)
+        for _ in range(2000):
+            deck = Deck()
+            hand = Stack(cards=[deck.deal() for _ in range(4)])
+            starter = deck.deal()
+            for is_crib in (False, True):
+                self.assertEqual(
+                    evaluate_cards(hand, starter, is_crib),
+                    evaluate_cards_reference(hand, starter, is_crib)
+                )
+
+    def test_evaluate_cards_batch(self):
+        random.seed(1)
+        np.random.seed(1)
+        hands, starters, is_crib, expected = [], [], [], []
+        for i in range(1000):
+            deck = Deck()
+            hand = Stack(cards=[deck.deal() for _ in range(4)])
+            starter = deck.deal()
+            hands.append([c.idx for c in hand])
+            starters.append(starter.idx)
+            is_crib.append(i % 2 == 0)
+            expected.append(evaluate_cards(hand, starter, i % 2 == 0))
+
+        points = evaluate_cards_batch(
+            np.array(hands), np.array(starters), np.array(is_crib))
+        self.assertEqual(points.tolist(), expected)
+
+        # Best possible hand.
+        hand = [Card(RANKS[4], SUITS[i]).idx for i in range(3)]
+        hand.append(Card(RANKS[10], SUITS[3]).idx)
+        starter = Card(RANKS[4], SUITS[3]).idx
+        self.assertEqual(evaluate_cards_batch([hand], [starter])[0], 29)
+
+    def test_rank_points(self):
+        random.seed(2)
+        np.random.seed(2)
+        for _ in range(2000):
+            deck = Deck()
+            hand = Stack(cards=[deck.deal() for _ in range(random.randint(2, 5))])
+            starter = deck.deal() if random.random() < 0.5 else None
+            self.assertEqual(
+                evaluate_cards(hand, starter),
+                evaluate_cards_reference(hand, starter)
+            )
+
+        # Double double run: 3 4 4 5 5 -> 4 runs of 3 and 2 pairs.
+        self.assertEqual(rank_points([3, 4, 4, 5, 5]), 12 + 4)
+        # Disjoint runs in a large hand both score. Fifteens: each face card
+        # with A-4 or 2-3.
+        self.assertEqual(rank_points([1, 2, 3, 4, 11, 12, 13]), 4 + 3 + 12)
+
+    def test_card_interned(self):
+        card = Card(RANKS[10], SUITS[2])
+        self.assertIs(card, Card(RANKS[10], SUITS[2]))
+        self.assertIs(card, Card.from_idx(card.idx))
+        self.assertEqual(hash(card), card.idx)
+        self.assertEqual((card.value, card.rank_value), (10, 11))
+        self.assertNotEqual(card, Card(RANKS[10], SUITS[1]))
+        self.assertRaises(ValueError, Card, 99, SUITS[0])
+
+    def test_deck(self):
+        deck = Deck()
+        card = deck.cards[10]
+        deck.remove_(card)
+        self.assertEqual(len(deck), 51)
+        self.assertNotIn(card, deck.cards)
+
+        # Removing an already removed card does nothing, remove() copies.
+        deck.remove_(card)
+        self.assertEqual(len(deck), 51)
+        self.assertEqual(len(deck.remove(deck.cards[0])), 50)
+        self.assertEqual(len(deck), 51)
+
+        deck.shuffle()
+        dealt = [deck.deal() for _ in range(51)]
+        self.assertEqual(len(set(dealt) | {card}), 52)
+        self.assertIsNone(deck.deal())
+
+        # The cards left to deal can be set.
+        deck.set_cards([CARDS[3], card, CARDS[40]])
+        self.assertEqual(len(deck), 3)
+        self.assertEqual(deck.cards, [CARDS[3], card, CARDS[40]])
+        deck.remove_(card)
+        self.assertEqual(deck.cards, [CARDS[3], CARDS[40]])
+        self.assertIs(deck.deal(), CARDS[3])
+
     def test_evaluate_play(self):
         table = Stack(
             cards=[
@@ -209,6 +327,26 @@ class CribbageEnvTest(unittest.TestCase):
             evaluate_table(table), 3
         )
 
+    def test_pegging_state(self):
+        # Compares with evaluate_table() on random tables under 31.
+        rng = np.random.default_rng(0)
+        low_cards = [c.idx for c in CARDS if c.rank_value <= 5]
+        for i in range(2000):
+            pegging, table = PeggingState(), Stack()
+            # Low cards give long tables with pairs and runs.
+            for idx in rng.permutation(low_cards if i % 2 else 52):
+                card = CARDS[idx]
+                if pegging.count + card.value > 31:
+                    break
+                table.add_(card)
+                self.assertEqual(pegging.play(card), evaluate_table(table))
+
+        # Run of 7, out of order.
+        pegging = PeggingState()
+        points = [pegging.play(Card(RANKS[i], SUITS[0]))
+                  for i in [6, 0, 2, 1, 3, 5, 4]]
+        self.assertEqual(points, [0, 0, 0, 3, 4, 0, 7])
+
     def test_cribbage_step(self):
 
         print("2 Player Interactive Mode:")
@@ -233,6 +371,646 @@ class CribbageEnvTest(unittest.TestCase):
 
             dealer = env.next_player(env.dealer)
 
+    def test_discard_values(self):
+        hand = [Card(RANKS[4], SUITS[i]) for i in range(3)] + [
+            Card(RANKS[10], SUITS[3]), Card(RANKS[0], SUITS[0]),
+            Card(RANKS[12], SUITS[1])]
+        values = discard_values(hand)
+        self.assertEqual(len(values), 15)
+
+        # The hand points are the mean over the 46 starters.
+        keep, throw, hand_points, crib_points = values[0]
+        deck = Deck()
+        for c in hand:
+            deck.remove_(c)
+        expected = np.mean(
+            [evaluate_cards(Stack(list(keep)), c) for c in deck.cards])
+        self.assertAlmostEqual(hand_points, expected)
+
+        # Keep the three fives and the jack, throw the ace and king.
+        self.assertEqual(set(best_discard(hand, dealer=False)),
+                         {hand[4], hand[5]})
+
+    def test_monte_carlo_workers(self):
+        from agents import MonteCarlo
+
+        env = CribbageEnv()
+        env.reset(dealer=0, seed=5)
+        hand = Stack.from_stack(env.hands[0])
+        splits = [(hand[0], hand[1]), (hand[2], hand[3])]
+
+        points = []
+        for n_workers in (1, 2):
+            agent = MonteCarlo(trials=3, n_workers=n_workers, seed=7)
+            points.append(agent.rollouts(hand, 0, 2, splits, 3).tolist())
+            agent.close()
+        self.assertEqual(points[0], points[1])
+
+    def test_monte_carlo_adaptive(self):
+        from agents import MIN_ROUND_TRIALS, MonteCarlo
+
+        env = CribbageEnv()
+        env.reset(dealer=0, seed=5)
+        hand = Stack.from_stack(env.hands[0])
+        splits = [(hand[i], hand[j]) for i in range(5) for j in range(i+1, 6)]
+        for seed in range(4):
+            agent = MonteCarlo(seed=seed, adaptive=True)
+            points, alive = agent.adaptive_rollouts(hand, 0, 2, splits)
+
+            # Every discard gets enough rollouts to be compared, and only
+            # the rollouts skipped by stopping early count as saved.
+            self.assertTrue(all(len(p) >= MIN_ROUND_TRIALS for p in points))
+            used = sum(len(p) for p in points)
+            budget = agent.trials * len(splits)
+            self.assertLessEqual(used, budget)
+            if agent.rollouts_saved:
+                self.assertEqual(used + agent.rollouts_saved, budget)
+                self.assertEqual(len(alive), 1)
+            else:
+                # The two last discards share what is left of the budget.
+                self.assertLess(budget - used, 2)
+
+    def test_ismcts(self):
+        from agents import ISMCTS, Greedy
+
+        env = CribbageEnv()
+        state, _, _, _ = env.reset(dealer=0, seed=5)
+        agent = ISMCTS(iterations=50, seed=0)
+        players = [agent, Greedy()]
+        roots, cards = [], []
+        while env.phase < 2:
+            if env.player == 0:
+                card = agent.play(env)
+                self.assertIn(card, env.state.hand)
+                roots.append(agent._root)
+                cards.append(card)
+            else:
+                card = players[1].play(env)
+            state, _, _, _ = env.step(card)
+
+        # The tree of the first discard is reused for the second one (the
+        # opponent's discard is hidden, so it is not in the tree).
+        self.assertIs(roots[1], roots[0].children[0, cards[0].idx])
+        self.assertGreater(roots[1].visits, 0)
+        self.assertEqual(agent.decisions, len(roots))
+        self.assertEqual(agent.total_iterations, 50 * len(roots))
+        self.assertGreater(agent.decisions_per_second, 0)
+
+        # With a time budget.
+        agent = ISMCTS(time_limit=0.05, seed=0)
+        env.reset(seed=6)
+        agent.play(env)
+        self.assertLess(agent.search_time, 1)
+
+    def test_monte_carlo_common_random_numbers(self):
+        from agents import MonteCarlo
+
+        env = CribbageEnv()
+        env.reset(dealer=0, seed=5)
+        hand = Stack.from_stack(env.hands[0])
+        agent = MonteCarlo(trials=3, seed=7, common_random_numbers=True)
+
+        # The same discard twice sees the same deals.
+        splits = [(hand[0], hand[1]), (hand[0], hand[1]), (hand[2], hand[3])]
+        points = agent.rollouts(hand, 0, 2, splits, 3)
+        self.assertEqual(points.shape, (3, 3))
+        self.assertEqual(points[0].tolist(), points[1].tolist())
+
+    def test_from_position(self):
+        hand = [Card(RANKS[i], SUITS[0]) for i in range(6)]
+        env = CribbageEnv.from_position(
+            [hand, None], dealer=1, scores=[10, 20], rng=0)
+        self.assertEqual(len(env.hands[1]), 6)
+        self.assertEqual(env.player, 1)
+        self.assertEqual(env.state.hand_id, 1)
+        self.assertEqual(env.state.player_score, 20)
+        cards = set(env.hands[0]) | set(env.hands[1]) | set(env.deck.cards)
+        self.assertEqual(len(cards), 52)
+
+        # A starter given in The Deal is drawn after the discards.
+        jack = Card("J", SUITS[3])
+        env = CribbageEnv.from_position(
+            [hand, None], dealer=0, starter=jack, rng=0)
+        self.assertEqual(env.deck.cards[0], jack)
+        for _ in range(4):
+            _, reward, _, _ = env.step(env.state.hand[0])
+        self.assertEqual(env.starter, [jack])
+        self.assertEqual(reward, 2)
+
+        # In The Deal, the crib tells who still has to discard.
+        env = CribbageEnv.from_position(
+            [None, None], dealer=0, crib=[Card(RANKS[12], SUITS[3])], rng=0)
+        self.assertEqual([len(h) for h in env.hands], [5, 6])
+        self.assertEqual(env.player, 1)
+
+        # In The Play, 5-4 on the table, a 6 makes 15 and a run of 3.
+        five, four, six = (Card(RANKS[4], SUITS[1]), Card(RANKS[3], SUITS[1]),
+                           Card(RANKS[5], SUITS[1]))
+        env = CribbageEnv.from_position(
+            [[six, Card(RANKS[12], SUITS[2]), Card(RANKS[0], SUITS[2])], None],
+            dealer=1, table=[five, four], played=[[five], [four]], player=0,
+            phase=1, rng=0)
+        self.assertEqual([len(h) for h in env.hands], [3, 3])
+        self.assertEqual(len(env.crib), 4)
+        self.assertEqual(env.table_value, 9)
+        _, reward, _, _ = env.step(six)
+        self.assertEqual(reward, 5)
+
+        # In The Show, the kept cards are shown.
+        fives = [Card(5, suit) for suit in SUITS[:3]]
+        hand = fives + [Card("J", SUITS[3])]
+        env = CribbageEnv.from_position(
+            [hand, None], dealer=1, phase=2, starter=Card(5, SUITS[3]), rng=0)
+        self.assertEqual(env.player, 0)
+        self.assertEqual([len(h) for h in env.hands], [0, 0])
+        self.assertEqual([len(p) for p in env.played], [4, 4])
+        _, reward, _, _ = env.step(None)
+        self.assertEqual(reward, 29)
+
+        # Inconsistent positions.
+        with self.assertRaises(ValueError):
+            CribbageEnv.from_position([fives, None], phase=2, rng=0)
+        with self.assertRaises(ValueError):
+            CribbageEnv.from_position(
+                [None, None], dealer=1, table=[five], played=[[four], []],
+                player=0, phase=1, rng=0)
+        with self.assertRaises(ValueError):
+            CribbageEnv.from_position(
+                [hand, None], dealer=1, played=[[five], []], player=0,
+                phase=1, rng=0)
+
+    def test_pegging_values(self):
+        five, king = Card(RANKS[4], SUITS[0]), Card(RANKS[12], SUITS[0])
+        # The king makes 15 and takes the go.
+        self.assertEqual(
+            pegging_values([[five], [king]], [], 0, 0), {five: -3})
+
+        def solve(env):
+            # Exhaustive search of the rest of The Play through env.step().
+            snapshot, player = env.snapshot(), env.player
+            best = None
+            for card in list(env.state.hand):
+                env.restore(snapshot)
+                points = np.zeros(2)
+                state, reward, _, _ = env.step(card)
+                points[state.reward_id] += reward
+                if env.phase == 1:
+                    points += solve(env)
+                if best is None or points[player] - points[1 - player] > \
+                        best[player] - best[1 - player]:
+                    best = points
+            env.restore(snapshot)
+            return best
+
+        for seed in range(10):
+            env = CribbageEnv()
+            state, _, _, _ = env.reset(seed=seed)
+            while env.phase == 0 or len(env.table) < seed % 3:
+                state, _, _, _ = env.step(state.hand[-1])
+            env.scores[:] = 0
+            snapshot, player = env.snapshot(), env.player
+            values = pegging_values(
+                env.hands, env.table, env.table_value, env.player)
+            self.assertEqual(sorted(values), sorted(env.state.hand))
+            for card, value in values.items():
+                env.restore(snapshot)
+                state, reward, _, _ = env.step(card)
+                points = np.zeros(2)
+                points[state.reward_id] += reward
+                if env.phase == 1:
+                    points += solve(env)
+                self.assertEqual(value, points[player] - points[1 - player])
+
+    def test_array_obs(self):
+        env = CribbageEnv(array_obs=True)
+        obs, _, done, _ = env.reset(seed=0)
+        self.assertTrue(env.observation_space.contains(obs))
+        self.assertEqual(obs[0:52].sum(), 6)
+
+        while not done:
+            # Actions are card indices.
+            action = np.flatnonzero(obs[0:52])[0] if env.phase < 2 else None
+            if env.phase == 1:
+                action = env.state.hand[0].idx
+            obs, _, done, _ = env.step(action)
+            self.assertIs(obs, env.observation())
+            self.assertEqual(env.reward_id, env.state.reward_id)
+        self.assertEqual(obs[211:].max(), env.scores.max())
+
+        # Observations stay in the observation space, even with the points
+        # of a hand and a crib shown by the dealer one point from winning.
+        for n_players in (2, 3, 4):
+            env = CribbageEnv(n_players=n_players, array_obs=True)
+            vec_env = VectorCribbageEnv(num_envs=16, n_players=n_players,
+                                        seed=n_players)
+            vec_obs, vec_mask = vec_env.reset()
+            for seed in range(5):
+                obs, _, done, _ = env.reset(seed=seed)
+                while not done:
+                    self.assertTrue(env.observation_space.contains(obs))
+                    mask = env.legal_action_mask()
+                    obs, _, done, _ = env.step(
+                        np.flatnonzero(mask)[0] if env.phase < 2 else None)
+                self.assertTrue(env.observation_space.contains(obs))
+            for _ in range(300):
+                self.assertTrue(vec_env.observation_space.contains(vec_obs))
+                vec_obs, _, _, vec_mask = vec_env.step(
+                    vec_mask.argmax(axis=1))
+        env = CribbageEnv(array_obs=True)
+        obs = env.observation_space.low.copy()
+        obs[OBS_SCORES] = MAX_ROUND_VALUE - 1 + 29 + 24
+        self.assertTrue(env.observation_space.contains(obs))
+
+    def test_records(self):
+        path = os.path.join(tempfile.mkdtemp(), "games")
+        env = CribbageEnv()
+        games = []
+        with GameWriter(path, seed=0) as writer:
+            env.record(writer)
+            for dealer in (None, 1):
+                state, _, done, _ = env.reset(dealer=dealer)
+                scores = []
+                while not done:
+                    card = state.hand[-1] if env.phase < 2 else None
+                    state, _, done, _ = env.step(card)
+                    scores.append(env.scores.copy())
+                games.append(scores)
+
+            # An unfinished game.
+            env.reset(seed=3)
+            env.step(env.state.hand[0])
+            env.record(None)
+
+        reader = GameReader(path)
+        self.assertEqual(len(reader), 3)
+        self.assertEqual([g.flags for g in reader], [2, 3, 0])
+        self.assertEqual(len(reader[2].steps), 1)
+        for game, scores in zip(reader, games):
+            self.assertEqual(len(game.steps), len(scores))
+            for (env, _, _, _), expected in zip(replay(game), scores):
+                self.assertEqual(env.scores.tolist(), expected.tolist())
+
+        # Appending to the same file.
+        with GameWriter(path) as writer:
+            env.record(writer)
+            env.reset()
+        reader = GameReader(path)
+        self.assertEqual(len(reader), 4)
+        self.assertEqual(reader[3].steps.tolist(), [])
+
+        # Recording from the middle of a game starts with the next one.
+        path = os.path.join(tempfile.mkdtemp(), "games")
+        env = CribbageEnv()
+        state, _, _, _ = env.reset(seed=1)
+        with GameWriter(path, seed=0) as writer:
+            env.record(writer)
+            env.step(state.hand[0])
+            state, _, done, _ = env.reset()
+            while not done:
+                card = state.hand[0] if env.phase < 2 else None
+                state, _, done, _ = env.step(card)
+            env.record(None)
+        reader = GameReader(path)
+        self.assertEqual(len(reader), 1)
+        self.assertEqual(len(list(replay(reader[0]))), len(reader[0].steps))
+
+    def test_server(self):
+        import asyncio
+        import json
+        from gym_cribbage.server import GameServer
+
+        async def client(path, n_players, bad_move=False):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(json.dumps(
+                {"type": "join", "players": n_players}).encode() + b"\n")
+            messages = []
+            while True:
+                message = json.loads(await reader.readline())
+                messages.append(message)
+                if message["type"] == "turn":
+                    legal = message["legal"]
+                if message["type"] in ("turn", "error"):
+                    # After an error, the seat is still to play.
+                    card = legal[0]
+                    if bad_move:
+                        bad_move = False
+                        card = [c for c in range(52) if c not in legal][0]
+                    writer.write(json.dumps(
+                        {"type": "play", "card": card}).encode() + b"\n")
+                elif message["type"] == "end":
+                    writer.close()
+                    return messages
+
+        async def stalled(path, n_players=2):
+            # Joins, then neither plays nor reads.
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(json.dumps(
+                {"type": "join", "players": n_players}).encode() + b"\n")
+            return writer
+
+        async def main():
+            path = os.path.join(tempfile.mkdtemp(), "server.sock")
+            game_server = GameServer(seed=0)
+            server = await game_server.start(path=path)
+            async with server:
+                stalled_writers = [await stalled(path) for _ in range(2)]
+                await asyncio.sleep(0.1)
+
+                # A client leaving a table before it fills up is let go.
+                reader, writer = await asyncio.open_unix_connection(path)
+                writer.write(b'{"type": "join", "players": 4}\n')
+                writer.write_eof()
+                await asyncio.sleep(0.1)
+                games = await asyncio.wait_for(asyncio.gather(
+                    client(path, 2, bad_move=True), client(path, 2),
+                    *[client(path, 3) for _ in range(3)]), 30)
+                stalled_writers.append(await stalled(path, 4))
+                self.assertEqual(await asyncio.wait_for(reader.read(), 5),
+                                 b"")
+                writer.close()
+
+                # The stalled game is stopped with the server.
+                self.assertEqual(len(game_server.games), 1)
+                await game_server.close()
+                self.assertEqual(len(game_server.games), 0)
+                for w in stalled_writers:
+                    w.close()
+            return games
+
+        games = asyncio.run(main())
+        for messages in games:
+            start, end = messages[0], messages[-1]
+            self.assertEqual(start["type"], "start")
+            self.assertGreaterEqual(max(end["scores"]), 121)
+            self.assertEqual(len(end["scores"]), start["n_players"])
+            # The other players' discards are hidden.
+            discards = [m for m in messages if m.get("event") == "Discard"]
+            self.assertTrue(all((m["card"] is None) ==
+                                (m["player"] != start["seat"])
+                                for m in discards))
+        errors = [m for m in games[0] if m["type"] == "error"]
+        self.assertEqual(len(errors), 1)
+
+    def test_generate_dataset(self):
+        from agents import Greedy, HighCard
+        from generate_dataset import generate_dataset
+
+        out_dir = tempfile.mkdtemp()
+        paths = generate_dataset(out_dir, 4, players=(Greedy, HighCard),
+                                 seed=0, shard_size=300, chunk_size=128)
+        shards = [np.load(path) for path in paths]
+        self.assertTrue(all(len(s['done']) == 300 for s in shards[:-1]))
+        done = np.concatenate([s['done'] for s in shards])
+        game = np.concatenate([s['game'] for s in shards])
+        self.assertEqual(done.sum(), 4)
+        self.assertEqual(sorted(set(game)), [0, 1, 2, 3])
+
+        # Actions are legal, and the same with two workers.
+        for s in shards:
+            played = s['action'] >= 0
+            self.assertTrue(s['mask'][played, s['action'][played]].all())
+            self.assertFalse(s['mask'][~played].any())
+        paths = generate_dataset(tempfile.mkdtemp(), 4,
+                                 players=(Greedy, HighCard), n_workers=2,
+                                 seed=0, shard_size=300, chunk_size=128)
+        reward = np.concatenate([np.load(path)['reward'] for path in paths])
+        self.assertEqual(sorted(reward), sorted(np.concatenate(
+            [s['reward'] for s in shards])))
+
+        # A worker dying without a word is noticed.
+        class Killed(object):
+            def play(self, env):
+                os._exit(3)
+        with self.assertRaisesRegex(RuntimeError, 'exited with code 3'):
+            generate_dataset(tempfile.mkdtemp(), 4, players=(Greedy, Killed),
+                             n_workers=2, seed=0, poll_interval=0.1)
+
+        # Agents get their seat, and the caller's random state is kept.
+        from functools import partial
+        from agents import MonteCarlo
+        state = random.getstate()
+        paths = generate_dataset(
+            tempfile.mkdtemp(), 1, players=(Greedy, partial(
+                MonteCarlo, trials=1)), seed=0, chunk_size=64)
+        self.assertEqual(random.getstate(), state)
+        for s in map(np.load, paths):
+            played = s['action'] >= 0
+            self.assertTrue(s['mask'][played, s['action'][played]].all())
+
+    def test_play_game(self):
+        from agents import ExpectedValue, Greedy, HighCard, MonteCarlo
+        from play import play_game
+
+        random.seed(0)
+        for n_players in (2, 3, 4):
+            env = CribbageEnv(n_players=n_players)
+            env.seed(n_players)
+            players = [MonteCarlo(player_num=0, trials=1, seed=0), Greedy(),
+                       ExpectedValue(), HighCard()][:n_players]
+            log = play_game(0, env, players)
+            self.assertEqual(len(log['seat']) % n_players, 0)
+            self.assertEqual(log['seat'][:n_players], list(range(n_players)))
+            self.assertTrue(all(log['done'][-n_players:]))
+
+            # The points of each seat add up to its score.
+            for seat in range(n_players):
+                rows = [k for k, s in enumerate(log['seat']) if s == seat]
+                points = sum(log[column][k] for k in rows
+                             for column in ('deal', 'play', 'show'))
+                self.assertEqual(points, env.scores[seat])
+                self.assertEqual(log['score'][rows[-1]], env.scores[seat])
+                self.assertEqual([log['hand'][k] for k in rows],
+                                 list(range(len(rows))))
+            self.assertGreaterEqual(env.scores.max(), 121)
+
+    def test_timings(self):
+        env = CribbageEnv()
+        dumps = []
+        timings = env.enable_timings(dump_every=2, dump=dumps.append)
+        for seed in range(4):
+            state, _, done, _ = env.reset(seed=seed)
+            while not done:
+                card = state.hand[0] if env.phase < 2 else None
+                state, _, done, _ = env.step(card)
+
+        counts = {k: v["calls"] for k, v in timings.as_dict().items()}
+        self.assertEqual(counts["reset"], 4)
+        self.assertEqual(len(dumps), 2)
+        self.assertEqual(counts["step"], counts["_step_deal"] +
+                         counts["_step_play"] + counts["_step_show"])
+        self.assertEqual(counts["_step_play"], counts["_evaluate_play"])
+        self.assertEqual(counts["_reset_hand"], counts["_new_deck"])
+        self.assertGreater(timings.time["step"], timings.time["_step_play"])
+
+        env.disable_timings()
+        self.assertIsNone(env.timings)
+        self.assertNotIn("step", vars(env))
+        env.reset()
+        self.assertEqual(timings.calls["reset"], 4)
+
+    def test_trace(self):
+        env = CribbageEnv()
+        self.assertIsNone(env.trace)
+        trace = env.enable_trace(maxlen=100000)
+        state, _, done, _ = env.reset(seed=0)
+        while not done:
+            card = state.hand[0] if env.phase < 2 else None
+            state, _, done, _ = env.step(card)
+
+        # Every point scored is in the trace.
+        scores = np.zeros(2, dtype=int)
+        for event in trace:
+            if isinstance(event, (Play, Go, Show)):
+                scores[event.player] += event.points
+            elif isinstance(event, Starter):
+                scores[event.dealer] += event.points
+        self.assertEqual(scores.tolist(), env.scores.tolist())
+        self.assertIsInstance(list(trace)[0], NewGame)
+
+        # Only the latest events are kept.
+        trace = env.enable_trace(maxlen=5)
+        env.reset(seed=0)
+        self.assertEqual(len(trace), 2)
+        for _ in range(4):
+            env.step(env.state.hand[0])
+        self.assertEqual(len(trace), 5)
+        self.assertIsInstance(list(trace)[-1], Starter)
+
+        # A verbose environment prints the events, without the hidden cards.
+        import contextlib
+        import io
+        out = io.StringIO()
+        env = CribbageEnv(verbose=True)
+        with contextlib.redirect_stdout(out):
+            state, _, done, _ = env.reset(seed=0)
+            while not done:
+                card = state.hand[0] if env.phase < 2 else None
+                state, _, done, _ = env.step(card)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "GAME\tNew Game!")
+        self.assertIn("GAME\tPlayer 0 discards to the crib", lines)
+        self.assertIn("GAME\tReset table", lines)
+        self.assertFalse(any(line.startswith("HAND") or "Crib:" in line
+                             for line in lines))
+
+    def test_legal_action_mask(self):
+        for n_players in (2, 3, 4):
+            env = CribbageEnv(n_players=n_players)
+            state, _, done, _ = env.reset(seed=n_players)
+            while not done:
+                mask = env.legal_action_mask()
+                legal = [c.idx for c in env.hands[env.player] if
+                         env.phase == 0 or env.phase == 1 and
+                         env.table_value + c.value <= MAX_TABLE_VALUE]
+                self.assertEqual(np.flatnonzero(mask).tolist(), sorted(legal))
+                if env.phase == 1:
+                    env.restore(env.snapshot())
+                    self.assertEqual(env.legal_action_mask().tolist(),
+                                     mask.tolist())
+                card = state.hand[-1] if env.phase < 2 else None
+                state, _, done, _ = env.step(card)
+
+    def test_vector_env(self):
+        # Replays the hands of a VectorCribbageEnv in a CribbageEnv, the
+        # rewards of each player must be the same.
+        rng = np.random.default_rng(0)
+        for n_players in (2, 3, 4):
+            vec_env = VectorCribbageEnv(num_envs=1, n_players=n_players, seed=0)
+            _, mask = vec_env.reset()
+            env = _deal_of(vec_env)
+
+            done = False
+            while not done:
+                action = rng.choice(np.flatnonzero(mask[0]))
+                state, reward, done, _ = env.step(CARDS[action])
+                expected = np.zeros(n_players, dtype=int)
+                expected[state.reward_id] += reward
+                while env.phase == 2 and not done:
+                    state, reward, done, _ = env.step(None)
+                    expected[state.reward_id] += reward
+
+                obs, rewards, dones, mask = vec_env.step([action])
+                self.assertEqual(rewards[0].tolist(), expected.tolist())
+                self.assertEqual(dones[0], done)
+                if not done and vec_env.crib_len[0] == 0 and \
+                        vec_env.phase[0] == 0:
+                    env = _deal_of(vec_env)
+                if not done:
+                    self.assertEqual(obs[0].tolist(),
+                                     env.observation().tolist())
+
+    def test_vector_env_heels_win(self):
+        # The dealer wins the game with two for his heels.
+        for n_players in (2, 3):
+            vec_env = VectorCribbageEnv(num_envs=1, n_players=n_players,
+                                        seed=0)
+            _, mask = vec_env.reset()
+            held = vec_env.held[0].any(0)
+            vec_env.starter[0] = [j for j in range(JACK, 52, 13)
+                                  if not held[j]][0]
+            dealer = vec_env.dealer[0]
+            vec_env.scores[0, dealer] = MAX_ROUND_VALUE - 1
+
+            env = _deal_of(vec_env)
+
+            done = False
+            while not done:
+                action = np.flatnonzero(mask[0])[0]
+                _, reward, done, _ = env.step(CARDS[action])
+                _, rewards, dones, mask = vec_env.step([action])
+                self.assertEqual(rewards[0, dealer], reward)
+                self.assertEqual(dones[0], done)
+            self.assertEqual(reward, 2)
+            self.assertEqual(env.phase, 1)
+            self.assertEqual(vec_env.phase[0], 0)
+
+    def test_snapshot_restore(self):
+        env = CribbageEnv()
+        state, _, _, _ = env.reset(dealer=0, seed=3)
+
+        # Discard, then play the first two cards of the hand twice.
+        for _ in range(4):
+            state, _, _, _ = env.step(state.hand[0])
+        snapshot = env.snapshot()
+        clone = env.clone()
+
+        rewards = []
+        for _ in range(2):
+            state, reward, _, _ = env.step(state.hand[0])
+            rewards.append(reward)
+        table = list(env.table)
+
+        env.restore(snapshot)
+        state = env.state
+        for reward in rewards:
+            state, r, _, _ = env.step(state.hand[0])
+            self.assertEqual(r, reward)
+        self.assertEqual(list(env.table), table)
+
+        # The clone did not move.
+        self.assertEqual(len(clone.table), 0)
+        self.assertEqual(list(clone.starter), list(env.starter))
+
+    def test_seed(self):
+        def play(env):
+            state, reward, done, _ = env.reset()
+            rewards = []
+            while not done:
+                state, reward, done, _ = env.step(
+                    state.hand[0] if env.phase < 2 else None)
+                rewards.append(reward)
+            return rewards
+
+        env1, env2 = CribbageEnv(), CribbageEnv()
+        env1.seed(42)
+        env2.seed(42)
+        self.assertEqual(play(env1), play(env2))
+
+        seed1, seed2 = spawn_seeds(42, 2)
+        env1.seed(seed1)
+        env2.seed(seed2)
+        self.assertNotEqual(play(env1), play(env2))
+
     def test_rank_suit_from_idx(self):
 
         rank, suit = RANKS[10], SUITS[3]